@@ -2,17 +2,31 @@ import os
 import json
 import re
 import shutil
+import subprocess
+import sys
 import time
 from pathlib import Path
-from urllib.parse import urljoin
+from typing import List, Optional, Tuple
 
 try:
     import requests  # type: ignore
 except Exception:
     requests = None  # type: ignore
 
+from inference_backend import set_thread_env
+
+# OpenMP/BLAS は初期化時にしかスレッド数を読まないので、torch/ultralytics の import より先に設定する
+set_thread_env(int(os.environ.get("AI_NUM_THREADS", "0")))
+
 from ultralytics import YOLO
 
+from decode_pipeline import DecodedBatch, DecodePipeline
+from detection_state import DetectionState
+from frame_dedup import FrameDeduper
+from ingest_client import IngestClient, UploadLedger, UploadQueue
+from inference_backend import benchmark_backends, configure_threads, load_model, select_device
+from work_claim import WorkClaimer
+
 # ===== 設定値（要件）=====
 MODEL_PATH = "Best Model.pt"
 STOCKOUT_CLASS = "empty"
@@ -20,69 +34,115 @@ CONF_THRESHOLD = 0.5
 RAW_DIR = "./store_data/raw_images"
 TARGET_DIR = "./store_data/images"
 ARCHIVE_DIR = "./store_data/archive"
+INPROGRESS_DIR = "./store_data/inprogress"  # ワーカーごとの処理中画像置き場（claim先）
 STATUS_FILE = os.environ.get("DETECTION_STATUS_FILE", "./store_data/status.json")
 
-# Apple Silicon MPS
-DEVICE = "mps"
+# 推論デバイス/バックエンド
+# - AI_DEVICE: auto（mps → cuda → cpu の順で選択）/ mps / cpu / cuda:0
+# - AI_BACKEND: pt / onnx / openvino（onnx/openvino はCPU向けエクスポート版。無ければ自動エクスポート）
+# - AI_NUM_THREADS: CPU推論のスレッド数（0ならライブラリ既定）
+# - AI_BENCHMARK=1: 起動時に各バックエンドのレイテンシを計測して表示
+DEVICE = os.environ.get("AI_DEVICE", "auto")
+BACKEND = os.environ.get("AI_BACKEND", "pt")
+NUM_THREADS = int(os.environ.get("AI_NUM_THREADS", "0"))
+RUN_BENCHMARK = os.environ.get("AI_BENCHMARK", "0") == "1"
 
 # 追加設定
 POLL_INTERVAL_SEC = 0.5
 ARCHIVE_RETENTION_DAYS = 3
 ARCHIVE_CLEANUP_INTERVAL_SEC = 60
 
+# バッチ推論: 最大 BATCH_SIZE 枚まとめて1回の predict にする。
+# 枚数が足りない時は BATCH_MAX_WAIT_MS だけ追加の画像を待つ
+BATCH_SIZE = max(1, int(os.environ.get("AI_BATCH_SIZE", "8")))
+BATCH_MAX_WAIT_MS = max(0, int(os.environ.get("AI_BATCH_MAX_WAIT_MS", "200")))
+THROUGHPUT_REPORT_INTERVAL_SEC = float(os.environ.get("AI_THROUGHPUT_REPORT_SEC", "30"))
+# 1周で処理するバッチ数/時間の上限。画像が途切れなくても停止指示やアーカイブ掃除を後回しにしない
+MAX_BATCHES_PER_ROUND = max(1, int(os.environ.get("AI_MAX_BATCHES_PER_ROUND", "8")))
+MAX_ROUND_SEC = float(os.environ.get("AI_MAX_ROUND_SEC", "5"))
+
+# パイプライン: 画像の読込/デコード/レターボックスを別スレッドで先行させ、推論と並列に動かす
+PIPELINE_ENABLED = os.environ.get("AI_PIPELINE", "0") == "1"
+PIPELINE_DECODE_WORKERS = max(1, int(os.environ.get("AI_DECODE_WORKERS", "2")))
+PIPELINE_DEPTH = max(1, int(os.environ.get("AI_PIPELINE_DEPTH", "2")))  # 先読みするバッチ数
+IMG_SIZE = int(os.environ.get("AI_IMG_SIZE", "640"))
+
+# 重複フレーム間引き: ロボット停止中のほぼ同一フレームは推論せずアーカイブする（Pillowが必要）
+# - AI_DEDUP_HISTORY: 比較する直近の推論済みフレーム数
+# - AI_DEDUP_MAX_DISTANCE: dHash(64bit) のハミング距離がこれ以下なら重複
+# - AI_DEDUP_MAX_AGE_SEC: これより古いフレームとは比べない
+DEDUP_ENABLED = os.environ.get("AI_DEDUP", "0") == "1"
+DEDUP_HISTORY = max(1, int(os.environ.get("AI_DEDUP_HISTORY", "8")))
+DEDUP_MAX_DISTANCE = max(0, int(os.environ.get("AI_DEDUP_MAX_DISTANCE", "4")))
+DEDUP_MAX_AGE_SEC = float(os.environ.get("AI_DEDUP_MAX_AGE_SEC", "60"))
+DEDUPER: Optional[FrameDeduper] = None
+
+# マルチプロセス: AI_WORKERS=N (N>1) でスーパーバイザとしてN個のワーカープロセスを起動する。
+# 各ワーカーは raw_images の画像を inprogress/<AI_WORKER_ID>/ へ rename して取得(claim)してから処理する
+NUM_WORKERS = max(1, int(os.environ.get("AI_WORKERS", "1")))
+WORKER_ID = os.environ.get("AI_WORKER_ID", "")
+SUPERVISOR_REPORT_INTERVAL_SEC = float(os.environ.get("AI_SUPERVISOR_REPORT_SEC", "30"))
+WORKER_RESTART_BACKOFF_SEC = 2.0
+
 # 任意: クラウド送信（sync_robots.py から移譲）
+# 送信は別スレッドのキューで行い、keep-alive の Session を共有する。送信済みは台帳に残す
 REMOTE_APP_URL = os.environ.get("REMOTE_APP_URL")
 INGEST_TOKEN = os.environ.get("INGEST_TOKEN")
+UPLOAD_WORKERS = max(1, int(os.environ.get("UPLOAD_WORKERS", "4")))
+UPLOAD_BATCH_SIZE = max(1, int(os.environ.get("UPLOAD_BATCH_SIZE", "16")))  # 1リクエストにまとめる最大枚数
+UPLOAD_LEDGER_FILE = os.environ.get("UPLOAD_LEDGER_FILE", "./store_data/uploaded_images.log")
+UPLOAD_SCAN_INTERVAL_SEC = 30.0
+UPLOAD_SCAN_MIN_AGE_SEC = 60.0
+UPLOADER: Optional[UploadQueue] = None
 
 
 def ensure_dirs() -> None:
     os.makedirs(RAW_DIR, exist_ok=True)
     os.makedirs(TARGET_DIR, exist_ok=True)
     os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    os.makedirs(INPROGRESS_DIR, exist_ok=True)
+
+
+# 検知ON/OFF（app.py が書く status.json。変わった時だけ読み直す）
+DETECTION_STATE = DetectionState(STATUS_FILE)
 
 
 def is_detection_active() -> bool:
-    if not os.path.exists(STATUS_FILE):
-        return False
-    try:
-        with open(STATUS_FILE, "r", encoding="utf-8") as f:
-            state = json.load(f)
-        if isinstance(state, dict):
-            return bool(state.get("active", False))
-        if isinstance(state, (bool, int, float)):
-            return bool(state)
-        return False
-    except Exception:
-        return False
+    return DETECTION_STATE.active
 
 
 def remote_enabled() -> bool:
     return bool(REMOTE_APP_URL and INGEST_TOKEN and requests is not None)
 
 
-def remote_headers() -> dict:
-    return {"X-Ingest-Token": INGEST_TOKEN} if INGEST_TOKEN else {}
-
-
-def upload_defect_image(path: str) -> bool:
+def create_uploader(is_housekeeper: bool) -> Optional[UploadQueue]:
+    """クラウド送信キューを作る。housekeeper は送り漏れの定期スキャンも担当する"""
     if not remote_enabled():
-        return False
-    if not os.path.exists(path):
-        return False
-
-    base = REMOTE_APP_URL.rstrip("/") + "/"
-    url = urljoin(base, "api/ingest/image")
-    try:
-        with open(path, "rb") as f:
-            files = {"file": (os.path.basename(path), f)}
-            r = requests.post(url, headers=remote_headers(), files=files, timeout=10)
-        if r.status_code >= 300:
-            print(f"⚠️ 画像アップロード失敗: {os.path.basename(path)} ({r.status_code})")
-            return False
-        return True
-    except Exception as e:
-        print(f"⚠️ 画像アップロード例外: {e}")
-        return False
+        return None
+    client = IngestClient(REMOTE_APP_URL, INGEST_TOKEN, timeout=10, pool_size=UPLOAD_WORKERS)
+    ledger = UploadLedger(UPLOAD_LEDGER_FILE)
+    if is_housekeeper:
+        try:
+            ledger.compact(set(os.listdir(TARGET_DIR)))
+        except OSError:
+            pass
+    uploader = UploadQueue(
+        client,
+        "api/ingest/image",
+        ledger,
+        workers=UPLOAD_WORKERS,
+        batch_endpoint="api/ingest/images",
+        batch_size=UPLOAD_BATCH_SIZE,
+    )
+    if is_housekeeper:
+        # 直後の即時送信と重ならないよう、少し古くなった画像だけを拾う
+        uploader.start_pending_scanner(
+            TARGET_DIR,
+            UPLOAD_SCAN_INTERVAL_SEC,
+            prefix="defect_",
+            min_age_sec=UPLOAD_SCAN_MIN_AGE_SEC,
+        )
+    return uploader
 
 
 def extract_timestamp_str(filename: str) -> str:
@@ -118,20 +178,251 @@ def build_defect_filename(src_name: str) -> str:
     return dst_name
 
 
-def detect_stockout(model: YOLO, img_path: str) -> bool:
+def _result_has_stockout(model: YOLO, result) -> bool:
+    names = result.names if hasattr(result, "names") else model.names
+    if result.boxes is None:
+        return False
+    for box in result.boxes:
+        cls_id = int(box.cls[0])
+        conf = float(box.conf[0])
+        class_name = str(names.get(cls_id, cls_id)) if isinstance(names, dict) else str(names[cls_id])
+        if class_name == STOCKOUT_CLASS and conf >= CONF_THRESHOLD:
+            return True
+    return False
+
+
+def detect_stockout(model: YOLO, img_path) -> bool:
     results = model.predict(img_path, conf=CONF_THRESHOLD, device=DEVICE, verbose=False)
+    return any(_result_has_stockout(model, result) for result in results)
+
+
+def detect_stockout_batch(model: YOLO, sources: list) -> List[bool]:
+    """複数画像（パス or デコード済み配列）を1回の predict でまとめて推論する（戻り値は同じ順序）"""
+    if not sources:
+        return []
+    results = model.predict(
+        list(sources),
+        conf=CONF_THRESHOLD,
+        device=DEVICE,
+        verbose=False,
+        batch=len(sources),
+    )
+    results = list(results)
+    if len(results) != len(sources):
+        raise RuntimeError(f"batch result size mismatch: {len(results)} != {len(sources)}")
+    return [_result_has_stockout(model, result) for result in results]
+
+
+class ThroughputMeter:
+    """推論スループット（images/sec）を集計して定期的に表示する"""
+
+    def __init__(self, report_interval_sec: float, stats_path: Optional[str] = None):
+        self.report_interval_sec = report_interval_sec
+        self.stats_path = stats_path  # スーパーバイザが読む集計ファイル
+        self.total_images = 0
+        self.total_skipped = 0
+        self._images = 0
+        self._skipped = 0
+        self._busy_sec = 0.0
+        self._last_report = time.monotonic()
+
+    def add_skipped(self, images: int) -> None:
+        self.total_skipped += images
+        self._skipped += images
+
+    def add(self, images: int, elapsed_sec: float) -> None:
+        self.total_images += images
+        self._images += images
+        self._busy_sec += elapsed_sec
+        now = time.monotonic()
+        if self._images and now - self._last_report >= self.report_interval_sec:
+            rate = self._images / self._busy_sec if self._busy_sec > 0 else 0.0
+            print(
+                f"📈 推論スループット: {rate:.2f} images/sec ({self._images}枚 / {self._busy_sec:.2f}s, batch<={BATCH_SIZE})"
+                f" 重複スキップ: {self._skipped}枚（累計 {self.total_skipped}枚）"
+            )
+            self._write_stats(rate)
+            self._images = 0
+            self._skipped = 0
+            self._busy_sec = 0.0
+            self._last_report = now
+
+    def _write_stats(self, rate: float) -> None:
+        if not self.stats_path:
+            return
+        stats = {
+            "pid": os.getpid(),
+            "total_images": self.total_images,
+            "total_skipped": self.total_skipped,
+            "images_per_sec": rate,
+            "updated_at": time.time(),
+        }
+        try:
+            tmp_path = f"{self.stats_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, self.stats_path)
+        except Exception:
+            pass
+
+
+def list_raw_images() -> List[str]:
+    return sorted(f for f in os.listdir(RAW_DIR) if f.lower().endswith(".jpg"))
+
+
+def collect_raw_batch() -> List[str]:
+    """
+    raw_images から最大 BATCH_SIZE 枚を集める。
+    足りない時は最大 BATCH_MAX_WAIT_MS だけ追加の到着を待つ（1枚も無ければ待たない）。
+    """
+    deadline = time.monotonic() + BATCH_MAX_WAIT_MS / 1000.0
+    while True:
+        files = list_raw_images()
+        if not files or len(files) >= BATCH_SIZE:
+            return files[:BATCH_SIZE]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return files
+        time.sleep(min(0.02, remaining))
+
+
+def claim_raw_batch(claimer: WorkClaimer) -> List[str]:
+    """
+    raw_images からバッチを集めて自分の作業ディレクトリへ claim する。
+    他ワーカーに先を越された分は集め直す（rename できない状態が続く時は諦めて空を返す）。
+    claim 後のファイルは raw_images から消えるので、処理に失敗しても同じ画像で回り続けない。
+    """
+    for _ in range(3):
+        names = collect_raw_batch()
+        if not names:
+            return []
+        claimed = claimer.claim(names)
+        if claimed:
+            return claimed
+    return []
+
+
+def archive_raw_image(raw_path: str, file_name: str) -> None:
+    archive_path = os.path.join(ARCHIVE_DIR, file_name)
+    if os.path.exists(archive_path):
+        archive_path = os.path.join(ARCHIVE_DIR, f"{time.time():.6f}_{file_name}")
+    shutil.move(raw_path, archive_path)
+    print(f"アーカイブ: {file_name}")
+
+
+def archive_error_image(raw_path: str, file_name: str) -> None:
+    # 同じファイルで無限リトライしないため、エラー時もアーカイブへ退避
+    try:
+        if os.path.exists(raw_path):
+            fallback_path = os.path.join(ARCHIVE_DIR, f"error_{time.time():.6f}_{file_name}")
+            shutil.move(raw_path, fallback_path)
+    except Exception:
+        pass
 
-    for result in results:
-        names = result.names if hasattr(result, "names") else model.names
-        if result.boxes is None:
+
+def handle_detection_result(file_name: str, raw_path: str, is_stockout: bool) -> None:
+    """推論結果に応じて images（欠品）か archive へ移動する"""
+    try:
+        if is_stockout:
+            dst_name = build_defect_filename(file_name)
+            dst_path = os.path.join(TARGET_DIR, dst_name)
+            shutil.move(raw_path, dst_path)
+            print(f"✅ 欠品検知: {dst_name}")
+            if UPLOADER is not None:
+                UPLOADER.submit(dst_path)
+        else:
+            archive_raw_image(raw_path, file_name)
+    except Exception as e:
+        print(f"⚠️ 移動エラー ({file_name}): {e}")
+        archive_error_image(raw_path, file_name)
+
+
+def _drop_duplicate_frames(
+    entries: list, sources: list, meter: ThroughputMeter, hashes: Optional[list] = None
+) -> Tuple[list, list]:
+    """
+    直近に推論したフレームとほぼ同一の画像は推論せずアーカイブし、残りを返す。
+    hashes（DecodePipeline が求めた dHash）があればそれを比べるだけで、画像を読み直さない
+    """
+    if DEDUPER is None:
+        return entries, sources
+    kept_entries = []
+    kept_sources = []
+    skipped = 0
+    for i, ((name, path), source) in enumerate(zip(entries, sources)):
+        duplicate = DEDUPER.is_duplicate_hash(hashes[i]) if hashes is not None else DEDUPER.is_duplicate(path)
+        if duplicate:
+            skipped += 1
+            try:
+                archive_raw_image(path, name)
+            except Exception as e:
+                print(f"⚠️ 移動エラー ({name}): {e}")
+                archive_error_image(path, name)
             continue
-        for box in result.boxes:
-            cls_id = int(box.cls[0])
-            conf = float(box.conf[0])
-            class_name = str(names.get(cls_id, cls_id)) if isinstance(names, dict) else str(names[cls_id])
-            if class_name == STOCKOUT_CLASS and conf >= CONF_THRESHOLD:
-                return True
-    return False
+        kept_entries.append((name, path))
+        kept_sources.append(source)
+    if skipped:
+        meter.add_skipped(skipped)
+    return kept_entries, kept_sources
+
+
+def _infer_entries(model: YOLO, entries: list, sources: list, meter: ThroughputMeter) -> list:
+    """entries[i]=(name, path) を sources[i] で推論。失敗した画像は None"""
+    started = time.monotonic()
+    try:
+        flags = detect_stockout_batch(model, sources)
+    except Exception as e:
+        # 壊れた画像が混ざるとバッチ全体が失敗するので、1枚ずつに切り替えて原因を切り分ける
+        print(f"⚠️ バッチ推論エラー（1枚ずつ再試行）: {e}")
+        flags = []
+        for (name, _), source in zip(entries, sources):
+            try:
+                flags.append(detect_stockout(model, source))
+            except Exception as e1:
+                print(f"⚠️ 推論エラー ({name}): {e1}")
+                flags.append(None)
+    meter.add(len(entries), time.monotonic() - started)
+    return flags
+
+
+def _handle_flags(entries: list, flags: list) -> None:
+    for (name, path), flag in zip(entries, flags):
+        if flag is None:
+            archive_error_image(path, name)
+            continue
+        handle_detection_result(name, path, flag)
+
+
+def process_batch(model: YOLO, work_dir: str, file_names: List[str], meter: ThroughputMeter) -> None:
+    entries = [(name, os.path.join(work_dir, name)) for name in file_names]
+    entries = [(name, path) for name, path in entries if os.path.isfile(path)]
+    entries, sources = _drop_duplicate_frames(entries, [path for _, path in entries], meter)
+    if not entries:
+        return
+    flags = _infer_entries(model, entries, sources, meter)
+    _handle_flags(entries, flags)
+
+
+def process_decoded_batch(model: YOLO, batch: DecodedBatch, meter: ThroughputMeter) -> None:
+    """DecodePipeline でデコード済みのバッチを推論して振り分ける"""
+    entries = []
+    sources = []
+    hashes = []
+    for name, path, image, error, h in zip(batch.names, batch.paths, batch.images, batch.errors, batch.hashes):
+        if not os.path.isfile(path):
+            continue  # 処理前に消された等
+        if image is None:
+            print(f"⚠️ デコードエラー ({name}): {error}")
+            archive_error_image(path, name)
+            continue
+        entries.append((name, path))
+        sources.append(image)
+        hashes.append(h)
+    entries, sources = _drop_duplicate_frames(entries, sources, meter, hashes)
+    if not entries:
+        return
+    flags = _infer_entries(model, entries, sources, meter)
+    _handle_flags(entries, flags)
 
 
 def cleanup_archive() -> None:
@@ -150,28 +441,117 @@ def cleanup_archive() -> None:
         print(f"⚠️ アーカイブ削除エラー: {e}")
 
 
-def upload_pending_defect_images(uploaded_images: set) -> None:
-    if not remote_enabled():
-        return
+def find_benchmark_image() -> Optional[str]:
+    for d in (RAW_DIR, ARCHIVE_DIR, TARGET_DIR):
+        try:
+            for name in sorted(os.listdir(d)):
+                if name.lower().endswith(".jpg"):
+                    return os.path.join(d, name)
+        except OSError:
+            continue
+    return None
+
+
+def _spawn_worker(worker_id: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env["AI_WORKER_ID"] = worker_id
+    env["AI_WORKERS"] = "1"
+    return subprocess.Popen([sys.executable, "-u", os.path.abspath(__file__)], env=env)
+
+
+def _report_worker_stats(worker_ids: List[str]) -> None:
+    total_rate = 0.0
+    lines = []
+    for worker_id in worker_ids:
+        path = os.path.join(INPROGRESS_DIR, worker_id, "stats.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+        except Exception:
+            lines.append(f"  {worker_id}: (集計なし)")
+            continue
+        rate = float(stats.get("images_per_sec", 0.0))
+        total_rate += rate
+        age = time.time() - float(stats.get("updated_at", 0.0))
+        lines.append(
+            f"  {worker_id}: pid={stats.get('pid')} {rate:.2f} images/sec "
+            f"累計{stats.get('total_images', 0)}枚 ({age:.0f}秒前)"
+        )
+    print(f"📊 ワーカー別スループット（合計 {total_rate:.2f} images/sec）")
+    for line in lines:
+        print(line)
+
+
+def run_supervisor(num_workers: int) -> None:
+    """N個のワーカープロセスを起動し、落ちたら作り直す"""
+    ensure_dirs()
+    worker_ids = [f"w{i}" for i in range(num_workers)]
+    procs = {worker_id: _spawn_worker(worker_id) for worker_id in worker_ids}
+    started_at = {worker_id: time.monotonic() for worker_id in worker_ids}
+    print(f"🧑‍✈️ スーパーバイザ起動: {num_workers}ワーカー {[(w, p.pid) for w, p in procs.items()]}")
 
+    last_report = time.monotonic()
     try:
-        for name in os.listdir(TARGET_DIR):
-            if not (name.endswith(".jpg") and name.startswith("defect_")):
-                continue
-            if name in uploaded_images:
-                continue
-            path = os.path.join(TARGET_DIR, name)
-            if upload_defect_image(path):
-                uploaded_images.add(name)
-    except Exception as e:
-        print(f"⚠️ 送信ループエラー: {e}")
+        while True:
+            time.sleep(1.0)
+            now = time.monotonic()
+            for worker_id, proc in procs.items():
+                code = proc.poll()
+                if code is None:
+                    continue
+                # 起動直後に落ち続ける時に再起動ループで張り付かないよう間隔を空ける
+                if now - started_at[worker_id] < WORKER_RESTART_BACKOFF_SEC:
+                    continue
+                print(f"💥 ワーカー {worker_id} (pid={proc.pid}) が終了しました (code={code})。再起動します")
+                procs[worker_id] = _spawn_worker(worker_id)
+                started_at[worker_id] = now
+
+            if now - last_report >= SUPERVISOR_REPORT_INTERVAL_SEC:
+                _report_worker_stats(worker_ids)
+                last_report = now
+    except KeyboardInterrupt:
+        print("\n🛑 ワーカーを停止します")
+    finally:
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs.values():
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
 
 
 def main() -> None:
-    ensure_dirs()
+    global DEVICE, BACKEND, DEDUPER, UPLOADER
 
-    print(f"🚀 モデルロード開始: {MODEL_PATH} (device={DEVICE})")
-    model = YOLO(MODEL_PATH)
+    if NUM_WORKERS > 1 and not WORKER_ID:
+        run_supervisor(NUM_WORKERS)
+        return
+
+    ensure_dirs()
+    worker_id = WORKER_ID or "main"
+    # スーパーバイザ配下では w0 だけが送信待ち画像の再送/アーカイブ掃除/孤児回収を担当する
+    is_housekeeper = worker_id in ("main", "w0")
+    claimer = WorkClaimer(RAW_DIR, INPROGRESS_DIR, worker_id)
+    returned = claimer.acquire()
+    returned += claimer.recover_orphans()
+    if returned:
+        print(f"♻️ 処理途中だった画像 {returned} 枚を raw_images に戻しました")
+    configure_threads(NUM_THREADS)
+    DEVICE = select_device(DEVICE)
+
+    if RUN_BENCHMARK:
+        sample = find_benchmark_image()
+        if sample:
+            print(f"⏱ バックエンド別レイテンシ計測: {sample}")
+            benchmark_backends(MODEL_PATH, sample, DEVICE, conf=CONF_THRESHOLD)
+        else:
+            print("⚠️ 計測用の画像が無いためベンチマークをスキップします")
+
+    print(f"🚀 モデルロード開始: {MODEL_PATH} (device={DEVICE}, backend={BACKEND}, batch={BATCH_SIZE}, max_wait={BATCH_MAX_WAIT_MS}ms)")
+    model, BACKEND, DEVICE = load_model(MODEL_PATH, BACKEND, DEVICE, num_threads=NUM_THREADS)
+    print(f"ℹ️ 推論バックエンド: {BACKEND} (device={DEVICE})")
     print(f"ℹ️ クラス一覧: {model.names}")
     print("👀 raw_images監視を開始します (Ctrl+Cで停止)")
 
@@ -180,7 +560,33 @@ def main() -> None:
     elif remote_enabled():
         print(f"🌐 クラウド送信有効: {REMOTE_APP_URL}")
 
-    uploaded_images: set = set()
+    if DEDUP_ENABLED:
+        DEDUPER = FrameDeduper(history=DEDUP_HISTORY, max_distance=DEDUP_MAX_DISTANCE, max_age_sec=DEDUP_MAX_AGE_SEC)
+        # パイプライン有効時はデコード済みの配列から cv2 でハッシュを求めるので Pillow は要らない
+        if DEDUPER.available or PIPELINE_ENABLED:
+            print(f"🪞 重複フレーム間引き有効 (history={DEDUP_HISTORY}, max_distance={DEDUP_MAX_DISTANCE})")
+        else:
+            print("⚠️ Pillow が無いため重複フレーム間引きを無効化します")
+            DEDUPER = None
+
+    UPLOADER = create_uploader(is_housekeeper)
+    meter = ThroughputMeter(THROUGHPUT_REPORT_INTERVAL_SEC, os.path.join(claimer.work_dir, "stats.json"))
+
+    pipeline: Optional[DecodePipeline] = None
+    if PIPELINE_ENABLED:
+        pipeline = DecodePipeline(
+            claimer.work_dir,
+            lambda: claim_raw_batch(claimer),
+            is_detection_active,
+            img_size=IMG_SIZE,
+            workers=PIPELINE_DECODE_WORKERS,
+            depth=PIPELINE_DEPTH,
+            idle_sleep_sec=POLL_INTERVAL_SEC,
+            hash_frames=DEDUPER is not None,
+        )
+        pipeline.start()
+        print(f"🧵 デコードパイプライン有効 (workers={PIPELINE_DECODE_WORKERS}, depth={PIPELINE_DEPTH}, imgsz={IMG_SIZE})")
+
     last_archive_cleanup = 0.0
     last_detection_active = None
 
@@ -195,57 +601,57 @@ def main() -> None:
                 last_detection_active = detection_active
 
             if not detection_active:
-                upload_pending_defect_images(uploaded_images)
+                if pipeline is not None:
+                    # 先読み済みのバッチは処理せず raw_images に戻す（他のワーカー/再開後に回す）
+                    for decoded in pipeline.drain():
+                        claimer.unclaim(decoded.names)
+                if is_housekeeper:
+                    now = time.time()
+                    if now - last_archive_cleanup >= ARCHIVE_CLEANUP_INTERVAL_SEC:
+                        cleanup_archive()
+                        claimer.recover_orphans()
+                        last_archive_cleanup = now
+                # 開始されたらすぐ起きる（status.json の rename を inotify で待つ）
+                DETECTION_STATE.wait(POLL_INTERVAL_SEC)
+                continue
+
+            # 1周あたり最大 MAX_BATCHES_PER_ROUND バッチ / MAX_ROUND_SEC 秒。バッチごとに停止指示を確かめる
+            round_deadline = time.monotonic() + MAX_ROUND_SEC
+            processed = 0
+            for _ in range(MAX_BATCHES_PER_ROUND):
+                if time.monotonic() >= round_deadline or not is_detection_active():
+                    break
+                if pipeline is not None:
+                    # デコード済みバッチを推論する（次のデコードは裏で進む）
+                    decoded = pipeline.next_batch(timeout=POLL_INTERVAL_SEC)
+                    if decoded is None:
+                        break
+                    process_decoded_batch(model, decoded, meter)
+                    processed += 1
+                else:
+                    batch = claim_raw_batch(claimer)
+                    if not batch:
+                        break
+                    process_batch(model, claimer.work_dir, batch, meter)
+                    processed += 1
+
+            if is_housekeeper:
                 now = time.time()
                 if now - last_archive_cleanup >= ARCHIVE_CLEANUP_INTERVAL_SEC:
                     cleanup_archive()
+                    claimer.recover_orphans()
                     last_archive_cleanup = now
-                time.sleep(POLL_INTERVAL_SEC)
-                continue
-
-            files = sorted(f for f in os.listdir(RAW_DIR) if f.lower().endswith(".jpg"))
-
-            for file_name in files:
-                raw_path = os.path.join(RAW_DIR, file_name)
-                if not os.path.isfile(raw_path):
-                    continue
 
-                try:
-                    is_stockout = detect_stockout(model, raw_path)
-
-                    if is_stockout:
-                        dst_name = build_defect_filename(file_name)
-                        dst_path = os.path.join(TARGET_DIR, dst_name)
-                        shutil.move(raw_path, dst_path)
-                        print(f"✅ 欠品検知: {dst_name}")
-                        if remote_enabled() and upload_defect_image(dst_path):
-                            uploaded_images.add(dst_name)
-                    else:
-                        archive_path = os.path.join(ARCHIVE_DIR, file_name)
-                        if os.path.exists(archive_path):
-                            archive_path = os.path.join(ARCHIVE_DIR, f"{time.time():.6f}_{file_name}")
-                        shutil.move(raw_path, archive_path)
-                        print(f"アーカイブ: {file_name}")
-                except Exception as e:
-                    print(f"⚠️ 推論/移動エラー ({file_name}): {e}")
-                    # 同じファイルで無限リトライしないため、エラー時もアーカイブへ退避
-                    try:
-                        if os.path.exists(raw_path):
-                            fallback_path = os.path.join(ARCHIVE_DIR, f"error_{time.time():.6f}_{file_name}")
-                            shutil.move(raw_path, fallback_path)
-                    except Exception:
-                        pass
-
-            upload_pending_defect_images(uploaded_images)
-
-            now = time.time()
-            if now - last_archive_cleanup >= ARCHIVE_CLEANUP_INTERVAL_SEC:
-                cleanup_archive()
-                last_archive_cleanup = now
-
-            time.sleep(POLL_INTERVAL_SEC)
+            if not processed:
+                time.sleep(POLL_INTERVAL_SEC)  # 画像が無い時だけ待つ（溜まっている間は続けて次の周へ）
     except KeyboardInterrupt:
         print("\n🛑 ai_worker を停止しました")
+    finally:
+        if pipeline is not None:
+            pipeline.stop()
+        claimer.release()
+        if UPLOADER is not None:
+            UPLOADER.close(wait=False)
 
 
 if __name__ == "__main__":
@@ -3,15 +3,30 @@ import json
 import time
 import threading
 import ast
-import csv
+import fcntl
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional, Tuple
-from flask import Flask, render_template, request, jsonify, send_from_directory, abort
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, abort
+
+from area_index import AreaIndex
+from detection_state import DetectionState
+from file_watch import create_watcher
+from leader_lock import LeaderElection
+from notification_store import NotificationStore
+from processed_ledger import ProcessedLedger
+from tracking_index import TrackingIndex
 
 app = Flask(__name__)
 
 # 2DLidar/SLAMの地図PNGを見やすくする前処理（Pillowが無い環境では自動スキップ）
 try:
+    from map_preprocess import load_config_from_env as load_map_preprocess_config  # type: ignore
     from map_preprocess import preprocess_map_png  # type: ignore
 except Exception:
     preprocess_map_png = None  # type: ignore
@@ -24,6 +39,11 @@ MAP_YAML_FILE = os.path.join(DATA_DIR, "map.yaml") # 地図の設定ファイル
 MAP_PNG_FILE = os.environ.get("MAP_PNG_FILE", os.path.join("static", "map.png"))   # Web表示用の地図画像
 AREAS_FILE = os.environ.get("AREAS_FILE", os.path.join(DATA_DIR, "areas.json")) # エリア設定の保存先
 STATUS_FILE = os.path.join(DATA_DIR, "status.json")  # 検知ON/OFF状態の保存先
+NOTIFICATION_STORE_FILE = os.environ.get("NOTIFICATION_STORE_FILE", os.path.join(DATA_DIR, "notifications.sqlite3"))  # 通知の保存先（全ワーカー共有）
+PROCESSED_LEDGER_FILE = os.environ.get("PROCESSED_LEDGER_FILE", os.path.join(DATA_DIR, "processed.sqlite3"))  # 通知済み画像の台帳
+TRACKING_STATE_FILE = f"{LOG_FILE}.state.json"  # 差分取り込み中の tracking.csv の世代
+MAP_HASH_FILE = os.path.join(DATA_DIR, "map_hashes.json")  # 取り込み済み地図の内容ハッシュ
+MONITOR_LOCK_FILE = os.path.join(DATA_DIR, "monitor.leader.lock")  # 監視スレッドを動かすワーカーを1つに決めるロック
 
 # ディレクトリ作成（Render等の初回起動でも落ちないように）
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -32,18 +52,27 @@ static_dir = os.path.dirname(MAP_PNG_FILE) or "static"
 os.makedirs(static_dir, exist_ok=True)
 
 # 監視状態
-notifications = [] # 画面に表示する通知リスト
-processed_files = set()
-notifications_lock = threading.Lock()
-processed_files_lock = threading.Lock()
-detection_state_lock = threading.Lock()
-MAX_NOTIFICATIONS = int(os.environ.get("MAX_NOTIFICATIONS", "200"))
+notifications_changed = threading.Condition()  # このプロセスでの通知の追加/リセットをストリームに知らせる
+MAX_NOTIFICATIONS = int(os.environ.get("MAX_NOTIFICATIONS", "200"))  # 画面/APIで返す件数
+NOTIFICATION_HISTORY_MAX = int(os.environ.get("NOTIFICATION_HISTORY_MAX", "10000"))  # SQLiteに残す件数
+NOTIFICATION_RETENTION_DAYS = float(os.environ.get("NOTIFICATION_RETENTION_DAYS", "30"))  # 0で期限なし
 MAX_PROCESSED_FILES = int(os.environ.get("MAX_PROCESSED_FILES", "5000"))
+SSE_KEEPALIVE_SEC = 15
+SSE_POLL_SEC = 1.0  # 他のワーカーが書いた通知に気付くまでの最大待ち
+SSE_MAX_STREAM_SEC = int(os.environ.get("SSE_MAX_STREAM_SEC", "300"))  # 1本のストリームを保持する最大時間（ブラウザは自動で再接続する）
+# 1ワーカーで同時に開くストリームの上限。ストリームはスレッドを占有するので、
+# Gunicorn の --threads より小さくして取り込みAPI等のためのスレッドを残す（超えた画面はポーリングに回す）
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "4"))
+SSE_RETRY_AFTER_SEC = 60
+sse_stream_slots = threading.BoundedSemaphore(max(1, SSE_MAX_STREAMS))
 
 # Render等で外部から取り込み（ingest）するためのトークン
 INGEST_TOKEN = os.environ.get("INGEST_TOKEN")
 MAX_CONTENT_LENGTH_MB = int(os.environ.get("MAX_CONTENT_LENGTH_MB", "20"))
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH_MB * 1024 * 1024
+# tar/zip は展開後のサイズが本文(MAX_CONTENT_LENGTH)よりずっと大きくなり得るので、展開側でも上限を掛ける
+INGEST_MAX_IMAGE_MB = int(os.environ.get("INGEST_MAX_IMAGE_MB", str(MAX_CONTENT_LENGTH_MB)))  # 1ファイルの上限
+INGEST_MAX_EXTRACT_MB = int(os.environ.get("INGEST_MAX_EXTRACT_MB", "200"))  # 1リクエストで書き込む合計の上限
 
 # Flask
 # - デプロイ環境では環境変数PORTが提供されることが多い
@@ -53,62 +82,26 @@ PORT = int(os.environ.get("PORT", "5000"))
 DEBUG = os.environ.get("FLASK_DEBUG", "0") == "1"
 
 
-def _normalize_detection_state(raw) -> dict:
-    active = False
-    updated_at: Optional[float] = None
-
-    if isinstance(raw, bool):
-        active = raw
-    elif isinstance(raw, (int, float)):
-        active = bool(raw)
-    if isinstance(raw, dict):
-        active = bool(raw.get("active", False))
-        raw_updated_at = raw.get("updated_at")
-        if raw_updated_at is not None:
-            try:
-                updated_at = float(raw_updated_at)
-            except Exception:
-                updated_at = None
-
-    return {
-        "active": active,
-        "updated_at": updated_at,
-    }
-
-
-def _read_detection_state_unlocked() -> dict:
-    if not os.path.exists(STATUS_FILE):
-        return _normalize_detection_state(None)
-
-    try:
-        with open(STATUS_FILE, "r", encoding="utf-8") as f:
-            return _normalize_detection_state(json.load(f))
-    except Exception:
-        return _normalize_detection_state(None)
+# 検知ON/OFF（stat で変化を確かめてキャッシュ。ai_worker も同じファイルを見る）
+detection_state = DetectionState(STATUS_FILE)
 
 
 def get_detection_state() -> dict:
-    with detection_state_lock:
-        return _read_detection_state_unlocked()
+    return detection_state.get()
 
 
 def set_detection_state(active: bool) -> dict:
-    state = {
-        "active": bool(active),
-        "updated_at": time.time(),
-    }
-    with detection_state_lock:
-        Path(os.path.dirname(STATUS_FILE) or ".").mkdir(parents=True, exist_ok=True)
-        tmp_path = f"{STATUS_FILE}.tmp"
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False)
-        os.replace(tmp_path, STATUS_FILE)
-    return state
+    return detection_state.set(active)
 
 
 def initialize_detection_state() -> None:
-    """アプリ起動時は必ず停止状態から開始する"""
-    set_detection_state(False)
+    """
+    状態ファイルが無ければ停止状態で作る。
+    アプリ起動時に停止状態へ戻すのは Gunicorn のマスター（gunicorn.conf.py の on_starting）で1回だけ。
+    ワーカーの import ごとに戻すと、ワーカーの再起動で他のワーカーから開始した検知まで止まってしまう
+    """
+    if not os.path.exists(STATUS_FILE):
+        set_detection_state(False)
 
 
 initialize_detection_state()
@@ -230,51 +223,101 @@ class MapConverter:
 # コンバーターのインスタンス作成
 converter = MapConverter()
 
+# tracking.csv の時刻インデックス（mtime/サイズが変わった時だけ読み直す）
+tracking_index = TrackingIndex(LOG_FILE, tolerance_sec=5.0)
+
+# 通知済み画像の台帳（SQLite。件数上限を超えたら古い順に間引く）
+processed_ledger = ProcessedLedger(PROCESSED_LEDGER_FILE, max_entries=MAX_PROCESSED_FILES)
+
+# 通知（SQLite。複数ワーカーが同じファイルを読む。件数/日数の上限を超えたら古い順に消す）
+notification_store = NotificationStore(
+    NOTIFICATION_STORE_FILE,
+    max_entries=max(MAX_NOTIFICATIONS, NOTIFICATION_HISTORY_MAX),
+    max_age_sec=NOTIFICATION_RETENTION_DAYS * 86400,
+)
+
+# areas.json のグリッドインデックス（保存時/mtime変化時だけ読み直す）
+area_index = AreaIndex(AREAS_FILE)
+
 # --- 監視ロジック (別スレッドで動かす) ---
 def monitoring_task():
-    """1秒ごとに新しい画像がないかチェックする"""
-    global notifications
+    """新しい画像をファイル監視（inotify/ポーリング）で拾って通知を作る"""
     print("👀 監視システム起動中...", flush=True)
-    
+
+    watcher = create_watcher(IMG_DIR, ".jpg")
+    print(f"👀 画像監視バックエンド: {watcher.backend}", flush=True)
+    needs_rescan = True
+    next_expire = 0.0
+    seen_reset_count = notification_store.state()[0]
+
     while True:
+        # 保存期間を過ぎた通知を消す（1分に1回）
+        if time.monotonic() >= next_expire:
+            next_expire = time.monotonic() + 60
+            try:
+                notification_store.expire()
+            except Exception as e:
+                print(f"⚠️ 通知の期限切れ削除に失敗: {e}", flush=True)
+
         # 地図設定を再読み込み（SLAMで地図が更新される可能性があるため）
         converter.reload_if_needed()
 
-        # 検知停止中は通知生成処理を行わず待機
+        # 検知停止中は通知生成処理を行わず待機（再開時に全件を見直す）
         if not get_detection_state().get("active", False):
-            time.sleep(1)
+            needs_rescan = True
+            # 再開されたらすぐ起きる（status.json の rename を inotify で待つ）
+            detection_state.wait(timeout=1.0)
             continue
 
         try:
-            # 1. 画像フォルダを見る
+            # 1. 画像フォルダを見る（起動/再開/リセット直後だけ全件、以降は新着のみ）
             if not os.path.exists(IMG_DIR):
+                needs_rescan = True
                 time.sleep(1)
                 continue
 
-            jpg_files = [f for f in os.listdir(IMG_DIR) if f.endswith(".jpg")]
-            
-            for filename in jpg_files:
-                filepath = os.path.join(IMG_DIR, filename)
-                with processed_files_lock:
-                    if filepath in processed_files:
-                        continue
+            # リセット（どのワーカーが受けたものでも）後は台帳を読み直して全件を見直す
+            reset_count = notification_store.state()[0]
+            if reset_count != seen_reset_count:
+                seen_reset_count = reset_count
+                processed_ledger.reload()
+                needs_rescan = True
+            if needs_rescan:
+                jpg_files = watcher.rescan()
+                needs_rescan = False
+            else:
+                # 新着が無ければ最大1秒待つ（待機中はCPUを使わない）
+                jpg_files = watcher.wait(timeout=1.0)
 
+            candidates = []
+            for filename in jpg_files:
                 # 2. ファイル名から時刻取得 (defect_1707...jpg)
                 try:
                     time_str = filename.replace("defect_", "").replace(".jpg", "")
                     photo_time = float(time_str)
                 except:
                     continue
+                candidates.append((filename, photo_time))
 
-                # 3. CSVからロボットの座標(メートル)を探す
-                world_x, world_y = get_location_from_log(photo_time)
-                
-                if world_x is not None:
-                    # ★ 4. メートルをピクセルに変換！
-                    pixel_x, pixel_y = converter.world_to_pixel(world_x, world_y)
+            # 通知済みの画像は台帳で除外（再起動/上限超過でも再処理しない）
+            pending = processed_ledger.filter_unprocessed(candidates)
 
-                    # 5. エリア判定 (ピクセル座標で判定)
-                    area_name = check_area(pixel_x, pixel_y)
+            # 3. CSVからロボットの座標(メートル)をまとめて補間して求める
+            locations = get_locations_from_log([p[1] for p in pending])
+
+            # ★ 4. メートルをピクセルに変換！
+            pixels = [
+                converter.world_to_pixel(world_x, world_y) if world_x is not None else None
+                for world_x, world_y in locations
+            ]
+
+            # 5. エリア判定 (ピクセル座標でまとめて判定)
+            area_names = iter(check_areas([p for p in pixels if p is not None]))
+
+            for (filename, photo_time), (world_x, world_y), pixel in zip(pending, locations, pixels):
+                if pixel is not None:
+                    pixel_x, pixel_y = pixel
+                    area_name = next(area_names)
 
                     # 6. 通知作成
                     msg = {
@@ -283,75 +326,49 @@ def monitoring_task():
                         "coords": f"({world_x:.2f}m, {world_y:.2f}m)", # 表示はメートルで
                         "img": filename
                     }
-                    with notifications_lock:
-                        notifications.insert(0, msg) # 最新を上に
-                        if len(notifications) > MAX_NOTIFICATIONS:
-                            del notifications[MAX_NOTIFICATIONS:]
+                    add_notification(msg, photo_time=photo_time)
                     print(f"🔔 通知: {area_name} で欠品！ (px: {int(pixel_x)}, {int(pixel_y)})", flush=True)
                 
-                with processed_files_lock:
-                    processed_files.add(filepath)
-                    if len(processed_files) > MAX_PROCESSED_FILES:
-                        processed_files.clear()
-            
-            time.sleep(1)
+                processed_ledger.mark_processed([(filename, photo_time)])
         except Exception as e:
             print(f"エラー: {e}", flush=True)
+            # 取りこぼし防止のため次回は全件を見直す
+            needs_rescan = True
             time.sleep(1)
 
-def get_location_from_log(target_time):
-    """ログファイルから時刻に近い座標を返す"""
-    if not os.path.exists(LOG_FILE): return None, None
-    try:
-        best_diff = None
-        best_x = None
-        best_y = None
-
-        with open(LOG_FILE, "r", encoding="utf-8", newline="") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) < 3:
-                    continue
-                try:
-                    t = float(row[0])
-                    x = float(row[1])
-                    y = float(row[2])
-                except Exception:
-                    continue
+def add_notification(msg: dict, *, photo_time: Optional[float] = None) -> dict:
+    """通知を保存して id を振り、このプロセスで待っているストリームを起こす"""
+    entry = notification_store.add(msg, photo_time=photo_time)
+    with notifications_changed:
+        notifications_changed.notify_all()
+    return entry
 
-                diff = abs(t - target_time)
-                if best_diff is None or diff < best_diff:
-                    best_diff = diff
-                    best_x = x
-                    best_y = y
+def clear_notifications() -> None:
+    notification_store.clear()
+    with notifications_changed:
+        notifications_changed.notify_all()
 
-        if best_diff is None or best_diff > 5.0:
-            return None, None  # 5秒以上ズレたら無視
-        return best_x, best_y
-    except:
+def get_location_from_log(target_time):
+    """ログファイルから時刻の座標を返す（前後のサンプルを線形補間）"""
+    try:
+        return tracking_index.interpolate(target_time)
+    except Exception:
         return None, None
 
-def check_area(x, y):
-    """座標(ピクセル)がどのエリアに入っているか"""
-    if not os.path.exists(AREAS_FILE): return "未設定エリア"
+def get_locations_from_log(target_times):
+    """get_location_from_log の一括版（1回のマージ走査で全画像分を求める）"""
     try:
-        with open(AREAS_FILE, 'r', encoding="utf-8") as f:
-            areas = json.load(f)
-        if not isinstance(areas, list):
-            return "未設定エリア"
+        return tracking_index.interpolate_many(target_times)
     except Exception:
-        return "未設定エリア"
-    
-    for area in areas:
-        # エリア定義(JSON)もピクセル座標なので、そのまま比較
-        try:
-            if (area['x'] <= x <= area['x'] + area['w'] and 
-                area['y'] <= y <= area['y'] + area['h']):
-                return area.get('name', "未設定エリア")
-        except Exception:
-            continue
-    
-    return "通路・不明"
+        return [(None, None)] * len(target_times)
+
+def check_area(x, y):
+    """座標(ピクセル)がどのエリアに入っているか"""
+    return area_index.lookup(x, y)
+
+def check_areas(points):
+    """check_area の一括版"""
+    return area_index.lookup_many(points)
 
 # --- Webサーバーのルート設定 ---
 @app.route('/')
@@ -373,6 +390,7 @@ def save_areas():
     with open(tmp_path, 'w', encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
     os.replace(tmp_path, AREAS_FILE)
+    area_index.invalidate()
     return jsonify({"status": "ok"})
 
 @app.route('/api/load_areas')
@@ -390,11 +408,133 @@ def load_areas():
 
 @app.route('/api/notifications')
 def get_notifications():
-    """フロントエンドに通知を送る"""
-    with notifications_lock:
-        snapshot = list(notifications)
-    return jsonify(snapshot)
+    """
+    フロントエンドに通知を送る（最新が先頭、最大 MAX_NOTIFICATIONS 件）。
+    - ?since=<id> を付けると、その id より新しい通知だけを {"notifications", "last_id", "reset"} で返す。
+      since が間引き/リセットで途切れていたり、新着が MAX_NOTIFICATIONS 件を超えていたら
+      reset=true で現在の一覧を返すので、クライアントは置き換える
+    - ?limit=N で件数を絞る（since 付きは古い方から N 件。続きは last_id から取り直す）
+    - ?area=<エリア名> でそのエリアの通知だけにする
+    - ETag は一覧の状態（リセット回数と最新 id）なので、変化が無ければ If-None-Match に 304 を返す
+    """
+    since_raw = request.args.get("since")
+    try:
+        since: Optional[int] = int(since_raw) if since_raw not in (None, "") else None
+        limit: Optional[int] = int(request.args["limit"]) if request.args.get("limit") else None
+    except ValueError:
+        return jsonify({"error": "since/limit must be integers"}), 400
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be >= 1"}), 400
+    area = request.args.get("area") or None
+
+    reset_count, seq, floor_id = notification_store.state()
+    etag = f"n{reset_count}-{seq}"
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
+    page = min(limit, MAX_NOTIFICATIONS) if limit is not None else MAX_NOTIFICATIONS
+    if since is None:
+        payload = notification_store.latest(page, area=area)
+    else:
+        newer = None
+        if floor_id <= since <= seq:
+            newer = notification_store.after(since, page if limit is not None else page + 1, area=area)
+            if limit is None and len(newer) > page:
+                newer = None  # 溜まりすぎ。差分より一覧を置き換えた方が早い
+        if newer is not None:
+            if limit is not None and len(newer) == page:
+                last_id = newer[-1]["id"]  # 続きがあるかもしれない
+            else:
+                last_id = max([seq] + [n["id"] for n in newer[-1:]])
+            newer.reverse()
+            payload = {"notifications": newer, "last_id": last_id, "reset": False}
+        else:
+            payload = {"notifications": notification_store.latest(page, area=area), "last_id": seq, "reset": True}
+
+    resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+def _sse_event(data, *, event: Optional[str] = None, event_id: Optional[int] = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False))
+    return "\n".join(lines) + "\n\n"
+
+@app.route('/api/notifications/stream')
+def stream_notifications():
+    """
+    通知の Server-Sent Events。
+    - 初回は snapshot イベントで現在の一覧を1回だけ送り、以降は新しい通知を notification イベントで1件ずつ送る
+    - 再接続時はブラウザが送る Last-Event-ID より新しい分だけを送る（IDが未知なら snapshot からやり直す）
+    - リセット時は reset イベント。SSE_MAX_STREAM_SEC ごとに切るのでブラウザ側が再接続する
+    - このワーカーのストリームが SSE_MAX_STREAMS 本を超えたら 503（画面は /api/notifications のポーリングに切り替える）
+    """
+    if not sse_stream_slots.acquire(blocking=False):
+        resp = jsonify({"status": "busy", "message": "too many streams; poll /api/notifications?since=<id>"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(SSE_RETRY_AFTER_SEC)
+        return resp
 
+    raw_last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_id: Optional[int] = int(raw_last_id) if raw_last_id else None
+    except ValueError:
+        last_id = None
+
+    def generate():
+        cursor = last_id
+        deadline = time.monotonic() + SSE_MAX_STREAM_SEC
+        yield "retry: 3000\n\n"
+        reset_count, seq, floor_id = notification_store.state()
+        pending = []
+        if cursor is None or not (floor_id <= cursor <= seq):
+            cursor = seq
+            snapshot = notification_store.latest(MAX_NOTIFICATIONS)
+            yield _sse_event({"notifications": snapshot, "limit": MAX_NOTIFICATIONS}, event="snapshot", event_id=seq)
+        else:
+            pending = notification_store.after(cursor, MAX_NOTIFICATIONS)
+
+        idle_since = time.monotonic()
+        while True:
+            for n in pending:
+                cursor = n["id"]
+                yield _sse_event(n, event="notification", event_id=cursor)
+            if pending:
+                idle_since = time.monotonic()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # 同じプロセスの通知はすぐ起こされる。他のワーカーが書いた分は SSE_POLL_SEC ごとに見に行く
+            with notifications_changed:
+                notifications_changed.wait(timeout=min(SSE_POLL_SEC, remaining))
+            current_reset, seq, _ = notification_store.state()
+            pending = notification_store.after(cursor, MAX_NOTIFICATIONS) if seq > cursor else []
+            if current_reset != reset_count:
+                reset_count = current_reset
+                # 一覧を空にさせる（リセット後に来た通知は続けて pending から送る）
+                yield _sse_event({}, event="reset")
+                idle_since = time.monotonic()
+            elif not pending and time.monotonic() - idle_since >= SSE_KEEPALIVE_SEC:
+                yield ": keepalive\n\n"
+                idle_since = time.monotonic()
+
+    resp = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # 途中で切断されても（ジェネレータが始まる前でも）枠を返す
+    resp.call_on_close(sse_stream_slots.release)
+    return resp
 
 @app.route('/api/detection/status')
 def get_detection_status():
@@ -426,7 +566,16 @@ def get_image(filename: str):
 
 @app.route('/healthz')
 def healthz():
-    return jsonify({"status": "ok"})
+    """死活確認。どのワーカー（pid）が監視スレッドを動かしているかも返す"""
+    if os.environ.get("DISABLE_MONITORING", "0") == "1":
+        monitor = {"disabled": True}
+    else:
+        monitor = {
+            "is_leader": monitor_election.is_leader,
+            "leader": monitor_election.leader(),
+            "restarts": monitor_election.failures,  # このワーカーで監視スレッドが落ちて辞任した回数
+        }
+    return jsonify({"status": "ok", "pid": os.getpid(), "monitor": monitor})
 
 def _require_ingest_token() -> Optional[tuple]:
     """ingest API用の簡易認証（未設定なら503）"""
@@ -444,6 +593,42 @@ def _safe_filename(name: str) -> str:
     base = os.path.basename(name)
     return base.replace("\x00", "")
 
+@contextmanager
+def _file_lock(lock_path: str):
+    """ファイルの書き込みを直列化する（Gunicornの複数ワーカーでも効くよう flock を使う）"""
+    Path(os.path.dirname(lock_path) or ".").mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # close で flock も解放される
+
+def _tracking_file_lock():
+    return _file_lock(f"{LOG_FILE}.lock")
+
+def _map_ingest_lock():
+    return _file_lock(f"{MAP_HASH_FILE}.lock")
+
+def _read_tracking_generation() -> str:
+    try:
+        with open(TRACKING_STATE_FILE, "r", encoding="utf-8") as f:
+            return str(json.load(f).get("generation") or "")
+    except Exception:
+        return ""
+
+def _write_tracking_generation(generation: str) -> None:
+    tmp_path = f"{TRACKING_STATE_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"generation": generation}, f)
+    os.replace(tmp_path, TRACKING_STATE_FILE)
+
+def _tracking_size() -> int:
+    try:
+        return os.path.getsize(LOG_FILE)
+    except OSError:
+        return 0
+
 @app.route('/api/ingest/tracking', methods=['POST'])
 def ingest_tracking():
     auth = _require_ingest_token()
@@ -455,10 +640,139 @@ def ingest_tracking():
 
     tmp_path = f"{LOG_FILE}.tmp"
     Path(os.path.dirname(LOG_FILE) or ".").mkdir(parents=True, exist_ok=True)
-    f.save(tmp_path)
-    os.replace(tmp_path, LOG_FILE)
+    with _tracking_file_lock():
+        f.save(tmp_path)
+        os.replace(tmp_path, LOG_FILE)
+        # 全体上書きされたので、差分送信側には最初から送り直してもらう
+        _write_tracking_generation("")
     return jsonify({"status": "ok"})
 
+@app.route('/api/ingest/tracking/delta', methods=['GET', 'POST'])
+def ingest_tracking_delta():
+    """
+    tracking.csv の差分（追記分）だけを取り込む。
+    - 送信側は自分の tracking.csv の「世代(generation)」と、本文が始まるバイト位置(offset)を付けて送る
+    - サーバーの tracking.csv は送信側と同じバイト列になるので、ファイルサイズがそのまま受信済み位置になる
+    - 受信済みの範囲を含む再送（リトライ）は重複分を捨てて追記するので、同じ行が2回入らない
+    - 世代が変わった（ロボット側でログが作り直された）時は offset=0 の送信で丸ごと置き換える
+    - 位置が合わない時は 409 で現在の generation/size を返すので、送信側はそこから送り直す
+    GET は現在の generation/size を返す（送信側の再起動時の再開用）。
+    """
+    auth = _require_ingest_token()
+    if auth:
+        return auth
+
+    if request.method == 'GET':
+        with _tracking_file_lock():
+            return jsonify({"status": "ok", "generation": _read_tracking_generation(), "size": _tracking_size()})
+
+    generation = request.args.get("generation") or ""
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        offset = -1
+    if not generation or offset < 0:
+        return jsonify({"status": "error", "message": "generation and offset required"}), 400
+    body = request.get_data(cache=False)
+
+    with _tracking_file_lock():
+        current_generation = _read_tracking_generation()
+        size = _tracking_size()
+        if generation != current_generation:
+            if offset != 0:
+                return jsonify({"status": "conflict", "generation": current_generation, "size": size}), 409
+            tmp_path = f"{LOG_FILE}.tmp"
+            with open(tmp_path, "wb") as out:
+                out.write(body)
+            os.replace(tmp_path, LOG_FILE)
+            _write_tracking_generation(generation)
+            return jsonify({"status": "ok", "generation": generation, "size": len(body), "appended": len(body)})
+
+        if offset > size:
+            # 間が抜けている（前の送信が届いていない）
+            return jsonify({"status": "conflict", "generation": current_generation, "size": size}), 409
+        new_bytes = body[size - offset:]
+        if new_bytes:
+            with open(LOG_FILE, "ab") as out:
+                out.write(new_bytes)
+        return jsonify({"status": "ok", "generation": generation, "size": size + len(new_bytes), "appended": len(new_bytes)})
+
+class _TooLarge(Exception):
+    pass
+
+def _copy_limited(src, dst, max_bytes: Optional[int]) -> int:
+    """src を dst に写し、max_bytes を超えたら _TooLarge（アーカイブの申告サイズは信用しない）"""
+    written = 0
+    while True:
+        chunk = src.read(1024 * 1024)
+        if not chunk:
+            return written
+        written += len(chunk)
+        if max_bytes is not None and written > max_bytes:
+            raise _TooLarge()
+        dst.write(chunk)
+
+def _store_ingested_image(name: str, fileobj, *, max_bytes: Optional[int] = None) -> dict:
+    """取り込んだ画像を IMG_DIR に tmp → os.replace で原子的に書き込む（1ファイル分の結果を返す）"""
+    filename = _safe_filename(name or "")
+    if not filename.lower().endswith(".jpg"):
+        return {"filename": filename, "status": "error", "message": "only .jpg allowed"}
+
+    Path(IMG_DIR).mkdir(parents=True, exist_ok=True)
+    tmp_path = os.path.join(IMG_DIR, f"{filename}.tmp")
+    final_path = os.path.join(IMG_DIR, filename)
+    try:
+        with open(tmp_path, "wb") as out:
+            size = _copy_limited(fileobj, out, max_bytes)
+        os.replace(tmp_path, final_path)
+    except _TooLarge:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return {"filename": filename, "status": "error", "message": "file too large"}
+    except Exception as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return {"filename": filename, "status": "error", "message": str(e)}
+    return {"filename": filename, "status": "ok", "size": size}
+
+def _iter_archive_members(fileobj, kind: str):
+    """tar/zip から (ファイル名, 読み出し用fileobj, 申告サイズ) を順に返す（ディレクトリ等は飛ばす）"""
+    if kind == "zip":
+        # zip は末尾の目次を読むのでシーク可能な一時ファイルに退避する
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+            shutil.copyfileobj(fileobj, spool, 1024 * 1024)
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    with zf.open(info) as member:
+                        yield info.filename, member, info.file_size
+        return
+
+    # tar はストリームのまま1メンバーずつ読む（gzip圧縮も可）
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+        for info in tf:
+            if not info.isfile():
+                continue
+            member = tf.extractfile(info)
+            if member is None:
+                continue
+            yield info.name, member, info.size
+
+def _archive_kind(content_type: str, filename: str = "") -> Optional[str]:
+    ct = (content_type or "").split(";", 1)[0].strip().lower()
+    name = (filename or "").lower()
+    if ct in ("application/zip", "application/x-zip-compressed") or name.endswith(".zip"):
+        return "zip"
+    if ct in ("application/x-tar", "application/gzip", "application/x-gtar") or name.endswith((".tar", ".tar.gz", ".tgz")):
+        return "tar"
+    return None
+
 @app.route('/api/ingest/image', methods=['POST'])
 def ingest_image():
     auth = _require_ingest_token()
@@ -468,16 +782,128 @@ def ingest_image():
     if f is None:
         return jsonify({"status": "error", "message": "file required"}), 400
 
-    filename = _safe_filename(f.filename or "")
-    if not filename.lower().endswith(".jpg"):
-        return jsonify({"status": "error", "message": "only .jpg allowed"}), 400
+    result = _store_ingested_image(f.filename or "", f.stream)
+    if result["status"] != "ok":
+        return jsonify(result), 400
+    return jsonify(result)
 
-    Path(IMG_DIR).mkdir(parents=True, exist_ok=True)
-    tmp_path = os.path.join(IMG_DIR, f"{filename}.tmp")
-    final_path = os.path.join(IMG_DIR, filename)
-    f.save(tmp_path)
-    os.replace(tmp_path, final_path)
-    return jsonify({"status": "ok", "filename": filename})
+@app.route('/api/ingest/images', methods=['POST'])
+def ingest_images():
+    """
+    複数画像を1リクエストで取り込む。
+    - multipart: file（複数可）/ files / archive（tar・zip）
+    - 本文が tar / zip そのもの（Content-Type: application/x-tar, application/zip）
+    ファイルごとに ingest_image と同じく原子的に書き込み、個別の結果を返す。
+    """
+    auth = _require_ingest_token()
+    if auth:
+        return auth
+
+    results = []
+    max_image = INGEST_MAX_IMAGE_MB * 1024 * 1024
+    budget = [INGEST_MAX_EXTRACT_MB * 1024 * 1024]  # このリクエストでまだ書き込める合計バイト数
+
+    def store_member(name: str, member, declared: int) -> None:
+        # 申告サイズで先に弾き、展開中も実際のバイト数で上限を確かめる
+        if declared > max_image:
+            results.append({"filename": _safe_filename(name), "status": "error", "message": "file too large"})
+            return
+        if declared > budget[0]:
+            raise _TooLarge()
+        limit = min(max_image, budget[0])
+        result = _store_ingested_image(name, member, max_bytes=limit)
+        if result["status"] != "ok" and limit < max_image and result.get("message") == "file too large":
+            raise _TooLarge()  # 1ファイルの上限ではなく合計の上限に掛かった
+        budget[0] -= result.get("size", 0)
+        results.append(result)
+
+    archive_kind = _archive_kind(request.content_type or "")
+    try:
+        if archive_kind is not None:
+            for name, member, declared in _iter_archive_members(request.stream, archive_kind):
+                store_member(name, member, declared)
+        else:
+            for key in ("file", "files", "archive"):
+                for f in request.files.getlist(key):
+                    kind = _archive_kind(f.mimetype or "", f.filename or "")
+                    if kind is None:
+                        results.append(_store_ingested_image(f.filename or "", f.stream, max_bytes=max_image))
+                        continue
+                    for name, member, declared in _iter_archive_members(f.stream, kind):
+                        store_member(name, member, declared)
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        return jsonify({"status": "error", "message": f"invalid archive: {e}", "results": results}), 400
+    except _TooLarge:
+        return jsonify({
+            "status": "error",
+            "message": f"archive expands beyond {INGEST_MAX_EXTRACT_MB}MB",
+            "results": results,
+        }), 413
+
+    if not results:
+        return jsonify({"status": "error", "message": "file required", "results": []}), 400
+    ok = sum(1 for r in results if r["status"] == "ok")
+    status = "ok" if ok == len(results) else ("partial" if ok else "error")
+    return jsonify({"status": status, "saved": ok, "results": results})
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _map_variant(kind: str) -> str:
+    """同じ元画像でも前処理の設定が変われば出力が変わるので、ハッシュと一緒に記録する"""
+    if kind == "map_png" and preprocess_map_png is not None:
+        return repr(load_map_preprocess_config())
+    return ""
+
+def _load_map_hashes() -> dict:
+    try:
+        with open(MAP_HASH_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+def _current_map_hash(kind: str, output_path: str) -> Optional[str]:
+    """取り込み済みの元ファイルのハッシュ。出力が別経路で差し替えられていたら None"""
+    record = _load_map_hashes().get(kind)
+    if not isinstance(record, dict):
+        return None
+    try:
+        mtime = os.path.getmtime(output_path)
+    except OSError:
+        return None
+    if record.get("output_mtime") != mtime or record.get("variant") != _map_variant(kind):
+        return None
+    return record.get("sha256")
+
+def _record_map_hash(kind: str, digest: str, output_path: str) -> None:
+    hashes = _load_map_hashes()
+    hashes[kind] = {
+        "sha256": digest,
+        "variant": _map_variant(kind),
+        "output_mtime": os.path.getmtime(output_path),
+    }
+    tmp_path = f"{MAP_HASH_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(hashes, f)
+    os.replace(tmp_path, MAP_HASH_FILE)
+
+@app.route('/api/ingest/map/status')
+def ingest_map_status():
+    """取り込み済み地図の内容ハッシュ（送信側は一致すれば本文を送らない）"""
+    auth = _require_ingest_token()
+    if auth:
+        return auth
+    with _map_ingest_lock():
+        return jsonify({
+            "status": "ok",
+            "map_yaml": _current_map_hash("map_yaml", MAP_YAML_FILE),
+            "map_png": _current_map_hash("map_png", MAP_PNG_FILE),
+        })
 
 @app.route('/api/ingest/map_png', methods=['POST'])
 def ingest_map_png():
@@ -488,18 +914,29 @@ def ingest_map_png():
     if f is None:
         return jsonify({"status": "error", "message": "file required"}), 400
     Path(os.path.dirname(MAP_PNG_FILE) or ".").mkdir(parents=True, exist_ok=True)
-    tmp_path = f"{MAP_PNG_FILE}.tmp"
-    f.save(tmp_path)
-    processed = False
-    if preprocess_map_png is not None:
-        try:
-            processed = bool(preprocess_map_png(tmp_path, tmp_path))
-        except Exception:
-            processed = False
-    os.replace(tmp_path, MAP_PNG_FILE)
+    with _map_ingest_lock():
+        tmp_path = f"{MAP_PNG_FILE}.tmp"
+        f.save(tmp_path)
+        digest = _sha256_file(tmp_path)
+        if digest == _current_map_hash("map_png", MAP_PNG_FILE):
+            # 同じ地図なので前処理も差し替えもしない
+            os.remove(tmp_path)
+            return jsonify({"status": "ok", "unchanged": True, "preprocessed": False, "sha256": digest})
+        processed = False
+        report: dict = {}
+        if preprocess_map_png is not None:
+            try:
+                processed = bool(preprocess_map_png(tmp_path, tmp_path, report=report))
+            except Exception:
+                processed = False
+        if processed:
+            stages = " ".join(f"{name}={ms:.0f}ms" for name, ms in report["stages_ms"].items())
+            print(f"🗺 地図前処理 ({report['engine']}) {report['total_ms']:.0f}ms: {stages}", flush=True)
+        os.replace(tmp_path, MAP_PNG_FILE)
+        _record_map_hash("map_png", digest, MAP_PNG_FILE)
     # 次ループでサイズ反映させる
     converter.reload_if_needed(force=True)
-    return jsonify({"status": "ok", "preprocessed": processed})
+    return jsonify({"status": "ok", "preprocessed": processed, "sha256": digest, "preprocess": report or None})
 
 @app.route('/api/ingest/map_yaml', methods=['POST'])
 def ingest_map_yaml():
@@ -510,11 +947,17 @@ def ingest_map_yaml():
     if f is None:
         return jsonify({"status": "error", "message": "file required"}), 400
     Path(os.path.dirname(MAP_YAML_FILE) or ".").mkdir(parents=True, exist_ok=True)
-    tmp_path = f"{MAP_YAML_FILE}.tmp"
-    f.save(tmp_path)
-    os.replace(tmp_path, MAP_YAML_FILE)
+    with _map_ingest_lock():
+        tmp_path = f"{MAP_YAML_FILE}.tmp"
+        f.save(tmp_path)
+        digest = _sha256_file(tmp_path)
+        if digest == _current_map_hash("map_yaml", MAP_YAML_FILE):
+            os.remove(tmp_path)
+            return jsonify({"status": "ok", "unchanged": True, "sha256": digest})
+        os.replace(tmp_path, MAP_YAML_FILE)
+        _record_map_hash("map_yaml", digest, MAP_YAML_FILE)
     converter.reload_if_needed(force=True)
-    return jsonify({"status": "ok"})
+    return jsonify({"status": "ok", "sha256": digest})
 
 @app.route('/api/ingest/reset', methods=['POST'])
 def ingest_reset():
@@ -522,17 +965,21 @@ def ingest_reset():
     auth = _require_ingest_token()
     if auth:
         return auth
-    with notifications_lock:
-        notifications.clear()
-    with processed_files_lock:
-        processed_files.clear()
+    # 台帳を先に消す（通知のリセットを見た監視スレッドが台帳を読み直すので、順序が逆だと古い台帳を読む）
+    processed_ledger.clear()
+    clear_notifications()
     return jsonify({"status": "ok"})
 
 _monitor_thread_started = False
 _monitor_thread_lock = threading.Lock()
+monitor_election = LeaderElection(MONITOR_LOCK_FILE)
 
 def start_monitoring_once() -> None:
-    """WSGI(Gunicorn等)でも確実に監視スレッドを起動する"""
+    """
+    WSGI(Gunicorn等)でも確実に監視スレッドを起動する。
+    複数ワーカーでは MONITOR_LOCK_FILE の flock を取れた1つだけが監視し、残りは待機して
+    リーダーのプロセスが落ちたら引き継ぐ。
+    """
     global _monitor_thread_started
     with _monitor_thread_lock:
         if _monitor_thread_started:
@@ -544,8 +991,7 @@ def start_monitoring_once() -> None:
         # 親プロセス側ではスレッドを起動しない（重複監視防止）。
         if DEBUG and os.environ.get("WERKZEUG_RUN_MAIN") != "true":
             return
-        t = threading.Thread(target=monitoring_task, daemon=True)
-        t.start()
+        monitor_election.start(monitoring_task)
         _monitor_thread_started = True
 
 # 起動時に監視スレッドを開始（誰も見ていない間の通知も溜める）
@@ -554,4 +1000,6 @@ start_monitoring_once()
 if __name__ == '__main__':
     # Webサーバー起動（開発用途）
     # 監視は起動済み。リローダは二重起動の原因になるため無効化しておく
+    # 開発サーバーは1プロセスなので、起動時の停止状態への初期化はここで行う
+    set_detection_state(False)
     app.run(debug=DEBUG, host=HOST, port=PORT, use_reloader=False)
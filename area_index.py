@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+UNSET_AREA_NAME = "未設定エリア"
+NO_AREA_NAME = "通路・不明"
+
+
+class AreaIndex:
+    """
+    areas.json（ピクセル座標の矩形リスト）を読み込んでグリッドに振り分け、
+    点がどのエリアに入るかをバケット内の候補だけで判定するインデックス。
+
+    - ファイルは mtime/サイズ/inode が変わった時だけ読み直す
+    - /api/save_areas で書き込んだ直後は invalidate() で即座に読み直させる
+    - 判定結果は従来どおり「リスト順で最初に当たったエリア」
+    """
+
+    def __init__(self, path: str, *, cell_size: float = 64.0, max_cells_per_area: int = 1024):
+        self.path = path
+        self.cell_size = float(cell_size)
+        self.max_cells_per_area = int(max_cells_per_area)
+
+        self._stat_key: Optional[Tuple[float, int, int]] = None
+        self._loaded = False  # areas.json が存在し、リストとして読めたか
+        self._bounds: List[Tuple[float, float, float, float]] = []
+        self._names: List[str] = []
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+        self._large: List[int] = []  # セル数が多すぎるエリアは線形判定に回す
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        """次の問い合わせで必ず読み直させる"""
+        with self._lock:
+            self._stat_key = None
+
+    def refresh(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            with self._lock:
+                self._reset_unlocked()
+            return
+
+        key = (st.st_mtime, st.st_size, st.st_ino)
+        with self._lock:
+            if key == self._stat_key:
+                return
+            self._load_unlocked()
+            self._stat_key = key
+
+    def _reset_unlocked(self) -> None:
+        self._stat_key = None
+        self._loaded = False
+        self._bounds = []
+        self._names = []
+        self._grid = {}
+        self._large = []
+
+    def _cell(self, v: float) -> int:
+        return int(math.floor(v / self.cell_size))
+
+    def _load_unlocked(self) -> None:
+        self._reset_unlocked()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                areas = json.load(f)
+        except Exception:
+            return
+        if not isinstance(areas, list):
+            return
+        self._loaded = True
+
+        for area in areas:
+            try:
+                x, y, w, h = area["x"], area["y"], area["w"], area["h"]
+                if not all(isinstance(v, (int, float)) for v in (x, y, w, h)):
+                    continue
+                x0, y0, x1, y1 = float(x), float(y), float(x + w), float(y + h)
+                name = area.get("name", UNSET_AREA_NAME)
+            except Exception:
+                continue
+            if x1 < x0 or y1 < y0 or any(math.isnan(v) for v in (x0, y0, x1, y1)):
+                continue  # 幅/高さが負の矩形には従来どおり何も当たらない
+
+            idx = len(self._bounds)
+            self._bounds.append((x0, y0, x1, y1))
+            self._names.append(name)
+
+            try:
+                cx0, cx1 = self._cell(x0), self._cell(x1)
+                cy0, cy1 = self._cell(y0), self._cell(y1)
+            except (OverflowError, ValueError):
+                self._large.append(idx)
+                continue
+            if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > self.max_cells_per_area:
+                self._large.append(idx)
+                continue
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self._grid.setdefault((cx, cy), []).append(idx)
+
+    def _lookup_unlocked(self, x: float, y: float) -> str:
+        if not self._loaded:
+            return UNSET_AREA_NAME
+
+        best: Optional[int] = None
+        try:
+            candidates = self._grid.get((self._cell(x), self._cell(y)), ())
+        except (OverflowError, ValueError):
+            candidates = ()
+        for idx in candidates:
+            if best is not None and idx >= best:
+                break  # バケット内はリスト順に並んでいる
+            x0, y0, x1, y1 = self._bounds[idx]
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                best = idx
+                break
+        for idx in self._large:
+            if best is not None and idx >= best:
+                break
+            x0, y0, x1, y1 = self._bounds[idx]
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                best = idx
+                break
+
+        if best is None:
+            return NO_AREA_NAME
+        return self._names[best]
+
+    def lookup(self, x: float, y: float) -> str:
+        """座標(ピクセル)が入っているエリア名"""
+        self.refresh()
+        with self._lock:
+            return self._lookup_unlocked(x, y)
+
+    def lookup_many(self, points: Sequence[Tuple[float, float]]) -> List[str]:
+        """lookup の一括版（ファイル確認とロックは1回だけ）"""
+        self.refresh()
+        with self._lock:
+            return [self._lookup_unlocked(x, y) for x, y in points]
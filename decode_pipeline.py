@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional, Tuple
+
+from frame_dedup import dhash_array
+
+
+@dataclass
+class DecodedBatch:
+    """
+    デコード済みバッチ。images[i] が None ならデコード失敗（errors[i] に理由）。
+    hashes[i] はデコード済みの配列から求めた dHash（hash_frames=False やハッシュ失敗なら None）
+    """
+
+    names: List[str]
+    paths: List[str]
+    images: List[Any]
+    errors: List[Optional[str]] = field(default_factory=list)
+    hashes: List[Optional[int]] = field(default_factory=list)
+    decode_sec: float = 0.0
+
+
+def letterbox(img, size: int, color=(114, 114, 114)):
+    """アスペクト比を保って size x size に収め、余白を埋める（YOLOの前処理と同じ考え方）"""
+    import cv2  # type: ignore
+
+    h, w = img.shape[:2]
+    scale = min(size / h, size / w)
+    new_w, new_h = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    pad_w, pad_h = size - new_w, size - new_h
+    left, top = pad_w // 2, pad_h // 2
+    return cv2.copyMakeBorder(
+        img, top, pad_h - top, left, pad_w - left, cv2.BORDER_CONSTANT, value=color
+    )
+
+
+def load_for_inference(path: str, img_size: int):
+    """JPEGを読み込み（BGR）、推論サイズにレターボックスした配列を返す"""
+    import cv2  # type: ignore
+
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"decode failed: {path}")
+    if img_size > 0:
+        img = letterbox(img, img_size)
+    return img
+
+
+def _load_and_hash(path: str, img_size: int, hash_frames: bool) -> Tuple[Any, Optional[int]]:
+    img = load_for_inference(path, img_size)
+    if not hash_frames:
+        return img, None
+    try:
+        return img, dhash_array(img)
+    except Exception:
+        return img, None  # 重複判定できないだけなので推論は続ける
+
+
+class DecodePipeline:
+    """
+    画像の読込/デコード/レターボックスを別スレッドで先行させ、推論と並列に動かす。
+
+    - collect() が返すファイル名のバッチを、スレッドプールでデコードしてキューに積む
+    - キューは maxsize 付きなので、推論が追いつかない時はデコード側が待つ（バックプレッシャ）
+    - is_active() が False の間は新しいバッチを集めない
+    - hash_frames=True なら、デコードしたスレッドでそのまま dHash も求める（推論スレッドはハッシュを比べるだけ）
+    """
+
+    def __init__(
+        self,
+        raw_dir: str,
+        collect: Callable[[], List[str]],
+        is_active: Callable[[], bool],
+        *,
+        img_size: int = 640,
+        workers: int = 2,
+        depth: int = 2,
+        idle_sleep_sec: float = 0.5,
+        hash_frames: bool = False,
+    ):
+        self.raw_dir = raw_dir
+        self.collect = collect
+        self.is_active = is_active
+        self.img_size = int(img_size)
+        self.workers = max(1, int(workers))
+        self.idle_sleep_sec = float(idle_sleep_sec)
+        self.hash_frames = bool(hash_frames)
+
+        self._queue: "queue.Queue[DecodedBatch]" = queue.Queue(maxsize=max(1, int(depth)))
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="decode-pipeline", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+
+    def next_batch(self, timeout: float) -> Optional[DecodedBatch]:
+        try:
+            return self._queue.get(timeout=max(0.0, timeout))
+        except queue.Empty:
+            return None
+
+    def drain(self) -> List[DecodedBatch]:
+        """キューに溜まっているデコード済みバッチを全部取り出す（停止時に claim を戻す用）"""
+        batches = []
+        while True:
+            try:
+                batches.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def _decode_batch(self, pool: ThreadPoolExecutor, names: List[str]) -> DecodedBatch:
+        started = time.perf_counter()
+        paths = [os.path.join(self.raw_dir, name) for name in names]
+        futures = [pool.submit(_load_and_hash, path, self.img_size, self.hash_frames) for path in paths]
+        images: List[Any] = []
+        errors: List[Optional[str]] = []
+        hashes: List[Optional[int]] = []
+        for fut in futures:
+            try:
+                img, h = fut.result()
+                images.append(img)
+                errors.append(None)
+                hashes.append(h)
+            except Exception as e:
+                images.append(None)
+                errors.append(str(e))
+                hashes.append(None)
+        return DecodedBatch(names, paths, images, errors, hashes, time.perf_counter() - started)
+
+    def _put(self, batch: DecodedBatch) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(batch, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="decode") as pool:
+            while not self._stop.is_set():
+                try:
+                    if not self.is_active():
+                        time.sleep(self.idle_sleep_sec)
+                        continue
+                    names = self.collect()
+                    if not names:
+                        time.sleep(self.idle_sleep_sec)
+                        continue
+                    if not self._put(self._decode_batch(pool, names)):
+                        return
+                except Exception as e:
+                    print(f"⚠️ デコードパイプラインエラー: {e}")
+                    time.sleep(self.idle_sleep_sec)
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+from file_watch import InotifyWatcher
+
+
+def normalize_detection_state(raw) -> dict:
+    active = False
+    updated_at: Optional[float] = None
+
+    if isinstance(raw, bool):
+        active = raw
+    elif isinstance(raw, (int, float)):
+        active = bool(raw)
+    if isinstance(raw, dict):
+        active = bool(raw.get("active", False))
+        raw_updated_at = raw.get("updated_at")
+        if raw_updated_at is not None:
+            try:
+                updated_at = float(raw_updated_at)
+            except Exception:
+                updated_at = None
+
+    return {
+        "active": active,
+        "updated_at": updated_at,
+    }
+
+
+class DetectionState:
+    """
+    status.json（欠品検知のON/OFF）をメモリに持っておき、stat だけで最新か確かめる。
+
+    - get() は stat の (inode, mtime, size) が前回と同じならキャッシュを返す（開いてJSONを読むのは変わった時だけ）
+    - set() は書き手ごとに別名の tmp に書いて rename するので、他のプロセスが読むのは常に書き終わったファイル
+      （複数ワーカーが同時に切り替えても tmp が混ざらず、後に rename した方が残る）
+    - wait() は切り替えを待つ。Linux では親ディレクトリの inotify で rename を受け取るので、
+      別プロセス（app ↔ ai_worker）からの切り替えでも数ミリ秒で起きる。inotify が無ければ stat を短い間隔で見る
+    """
+
+    POLL_SEC = 0.1
+
+    def __init__(self, path: str, *, watch: bool = True):
+        self.path = path
+        self._lock = threading.Lock()
+        self._key: Optional[Tuple[int, int, int]] = (-1, -1, -1)  # 初回の get() で必ず読む
+        self._state = normalize_detection_state(None)
+        self._watcher: Optional[InotifyWatcher] = None
+
+        if watch and sys.platform.startswith("linux"):
+            directory = os.path.dirname(os.path.abspath(path))
+            try:
+                Path(directory).mkdir(parents=True, exist_ok=True)
+                self._watcher = InotifyWatcher(directory, os.path.basename(path))
+            except Exception as e:
+                print(f"⚠️ 検知状態の inotify が使えないため stat で確認します: {e}", flush=True)
+
+    def _stat_key(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _reload_unlocked(self, key: Optional[Tuple[int, int, int]]) -> None:
+        state = normalize_detection_state(None)
+        if key is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    state = normalize_detection_state(json.load(f))
+            except Exception:
+                pass
+        self._key = key
+        self._state = state
+
+    def get(self) -> dict:
+        """現在の状態（ファイルが変わっていなければ読まずにキャッシュを返す）"""
+        key = self._stat_key()
+        with self._lock:
+            if key != self._key:
+                self._reload_unlocked(key)
+            return dict(self._state)
+
+    @property
+    def active(self) -> bool:
+        return self.get()["active"]
+
+    def set(self, active: bool) -> dict:
+        state = {
+            "active": bool(active),
+            "updated_at": time.time(),
+        }
+        directory = os.path.dirname(self.path) or "."
+        with self._lock:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(self.path)}.", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(state, f, ensure_ascii=False)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            self._key = self._stat_key()
+            self._state = normalize_detection_state(state)
+        return state
+
+    def wait(self, timeout: float) -> dict:
+        """
+        状態ファイルが変わるか timeout 秒経つまで待って、その時点の状態を返す。
+        inotify の読み出しは1スレッドからだけ呼ぶこと（get() はどのスレッドからでもよい）
+        """
+        state = self.get()
+        with self._lock:
+            key = self._key
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            if self._stat_key() != key:
+                return self.get()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return state
+            if self._watcher is not None:
+                # 同じディレクトリの他のファイルの書き込みでも起きるので、stat で確かめ直す
+                self._watcher.wait(timeout=remaining)
+            else:
+                time.sleep(min(self.POLL_SEC, remaining))
+
+    def close(self) -> None:
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
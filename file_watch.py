@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from typing import List, Optional, Set
+
+# inotify 定数（<sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class PollingWatcher:
+    """
+    ディレクトリの mtime を見て、変化した時だけ listdir する監視バックエンド。
+    inotify が使えない環境（macOS等）向けのフォールバック。
+    """
+
+    backend = "poll"
+
+    def __init__(
+        self,
+        path: str,
+        suffix: str = ".jpg",
+        *,
+        interval_sec: float = 0.2,
+        full_rescan_sec: float = 30.0,
+    ):
+        self.path = path
+        self.suffix = suffix
+        self.interval_sec = float(interval_sec)
+        # mtimeの分解能が粗いFS対策で、たまに無条件で読み直す
+        self.full_rescan_sec = float(full_rescan_sec)
+
+        self._known: Set[str] = set()
+        self._dir_mtime: Optional[int] = None
+        self._last_full_scan = 0.0
+
+    def _scan(self) -> List[str]:
+        try:
+            names = {n for n in os.listdir(self.path) if n.endswith(self.suffix)}
+        except OSError:
+            names = set()
+        new = sorted(names - self._known)
+        self._known = names
+        self._last_full_scan = time.monotonic()
+        return new
+
+    def rescan(self) -> List[str]:
+        """ディレクトリ内の対象ファイルを全て返す（起動時/再開時用）"""
+        self._known = set()
+        try:
+            self._dir_mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self._dir_mtime = None
+        return self._scan()
+
+    def wait(self, timeout: float = 1.0) -> List[str]:
+        """新しく現れたファイル名を返す。timeout 秒以内に無ければ空リスト"""
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            try:
+                mtime: Optional[int] = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            now = time.monotonic()
+            if mtime != self._dir_mtime or now - self._last_full_scan >= self.full_rescan_sec:
+                self._dir_mtime = mtime
+                new = self._scan()
+                if new:
+                    return new
+            if now >= deadline:
+                return []
+            time.sleep(min(self.interval_sec, max(0.0, deadline - now)))
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    Linux の inotify を ctypes 経由で使う監視バックエンド（追加依存なし）。
+    書き込み完了（IN_CLOSE_WRITE）と rename での移動（IN_MOVED_TO）だけを拾うので、
+    書きかけのJPEGを拾わない。
+    """
+
+    backend = "inotify"
+
+    def __init__(self, path: str, suffix: str = ".jpg"):
+        self.path = path
+        self.suffix = suffix
+
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_init1.argtypes = [ctypes.c_int]
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._fd = fd
+        self._wd: Optional[int] = None
+        self._needs_rescan = False
+        try:
+            self._add_watch()
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _add_watch(self) -> None:
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(self.path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), self.path)
+        self._wd = wd
+
+    def rescan(self) -> List[str]:
+        """ディレクトリ内の対象ファイルを全て返す（起動時/再開時/キューあふれ時用）"""
+        self._needs_rescan = False
+        try:
+            return sorted(n for n in os.listdir(self.path) if n.endswith(self.suffix))
+        except OSError:
+            return []
+
+    def _read_events(self) -> List[str]:
+        names: List[str] = []
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not buf:
+                break
+
+            pos = 0
+            while pos + _EVENT_HEADER.size <= len(buf):
+                _, mask, _, name_len = _EVENT_HEADER.unpack_from(buf, pos)
+                pos += _EVENT_HEADER.size
+                raw_name = buf[pos : pos + name_len].rstrip(b"\0")
+                pos += name_len
+
+                if mask & IN_Q_OVERFLOW:
+                    self._needs_rescan = True
+                elif mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # 監視ディレクトリ自体が消えた/差し替わった
+                    self._wd = None
+                    self._needs_rescan = True
+                elif raw_name:
+                    name = os.fsdecode(raw_name)
+                    if name.endswith(self.suffix):
+                        names.append(name)
+        return names
+
+    def wait(self, timeout: float = 1.0) -> List[str]:
+        """新しく書き込み完了/移動されてきたファイル名を返す。timeout 秒以内に無ければ空リスト"""
+        if self._wd is None:
+            try:
+                self._add_watch()
+            except OSError:
+                time.sleep(max(0.0, timeout))
+                return []
+            self._needs_rescan = True
+        if self._needs_rescan:
+            return self.rescan()
+
+        ready, _, _ = select.select([self._fd], [], [], max(0.0, timeout))
+        if not ready:
+            return []
+        names = self._read_events()
+        if self._needs_rescan:
+            return self.rescan()
+        # 同じファイルの重複イベントは1つにまとめる（順序は維持）
+        return list(dict.fromkeys(names))
+
+    def close(self) -> None:
+        try:
+            os.close(self._fd)
+        except OSError:
+            pass
+
+
+def create_watcher(path: str, suffix: str = ".jpg", backend: Optional[str] = None):
+    """
+    ファイル監視バックエンドを作る。
+    backend: "auto"（既定）/ "inotify" / "poll"。環境変数 FILE_WATCH_BACKEND でも指定可。
+    """
+    if backend is None:
+        backend = os.environ.get("FILE_WATCH_BACKEND", "auto")
+    backend = backend.lower()
+
+    if backend in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(path, suffix)
+        except Exception as e:
+            if backend == "inotify":
+                raise
+            print(f"⚠️ inotify が使えないためポーリング監視にします: {e}", flush=True)
+    return PollingWatcher(path, suffix)
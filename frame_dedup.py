@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+try:
+    from PIL import Image  # type: ignore
+except Exception:
+    Image = None  # type: ignore
+
+HASH_SIZE = 8  # 8x8 = 64bit の dHash
+
+
+def _hash_bits(pixels: bytes, hash_size: int) -> int:
+    value = 0
+    width = hash_size + 1
+    for row in range(hash_size):
+        base = row * width
+        for col in range(hash_size):
+            value = (value << 1) | (1 if pixels[base + col] > pixels[base + col + 1] else 0)
+    return value
+
+
+def dhash(path: str, hash_size: int = HASH_SIZE) -> int:
+    """差分ハッシュ（dHash）。縮小グレースケールの隣接画素の大小を1bitずつ並べたもの"""
+    if Image is None:
+        raise RuntimeError("Pillow is required for dhash")
+    with Image.open(path) as img:
+        # JPEGは draft で縮小デコードできるので、フルサイズを展開せずに済む
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+        pixels = small.tobytes()
+    return _hash_bits(pixels, hash_size)
+
+
+def dhash_array(img, hash_size: int = HASH_SIZE) -> int:
+    """デコード済みの配列（BGR/グレースケール）の dHash。ファイルを読み直さない（DecodePipeline 用）"""
+    import cv2  # type: ignore
+
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return _hash_bits(small.tobytes(), hash_size)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class FrameDeduper:
+    """
+    ロボット停止中に届くほぼ同一のフレームを推論前に間引く。
+
+    - 直近 history 枚の「推論したフレーム」の dHash と比べ、ハミング距離が max_distance 以下なら重複
+    - 重複と判定したフレームは履歴に足さない（少しずつ変わる映像で延々とスキップし続けないため）
+    - max_age_sec より古い履歴とは比べない（同じ棚に戻ってきた時は改めて推論する）
+    """
+
+    def __init__(self, *, history: int = 8, max_distance: int = 4, max_age_sec: float = 60.0):
+        self.max_distance = int(max_distance)
+        self.max_age_sec = float(max_age_sec)
+        self._recent: Deque[Tuple[int, float]] = deque(maxlen=max(1, int(history)))
+        self.checked = 0
+        self.skipped = 0
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    def is_duplicate(self, path: str) -> bool:
+        """重複なら True。新しいフレームなら履歴に登録して False（ハッシュ失敗時も False）"""
+        if Image is None:
+            return False
+        try:
+            h = dhash(path)
+        except Exception:
+            return False  # 壊れた画像は推論側のエラー処理に任せる
+        return self.is_duplicate_hash(h)
+
+    def is_duplicate_hash(self, h: Optional[int]) -> bool:
+        """計算済みの dHash で判定する（None はハッシュ失敗として False）"""
+        if h is None:
+            return False
+
+        self.checked += 1
+        now = time.monotonic()
+        for prev, seen_at in self._recent:
+            if now - seen_at <= self.max_age_sec and hamming(h, prev) <= self.max_distance:
+                self.skipped += 1
+                return True
+
+        self._recent.append((h, now))
+        return False
@@ -0,0 +1,14 @@
+"""
+Gunicorn の設定（カレントディレクトリの gunicorn.conf.py は自動で読み込まれる）。
+ワーカー数などは Procfile / Dockerfile のコマンドラインで指定している。
+"""
+
+import os
+
+from detection_state import DetectionState
+
+
+def on_starting(server):
+    """マスター起動時に1回だけ、検知を停止状態から開始する（ワーカーの再起動では戻さない）"""
+    status_file = os.path.join(os.environ.get("DATA_DIR", "./store_data"), "status.json")  # app.STATUS_FILE と同じ
+    DetectionState(status_file, watch=False).set(False)
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+# ai_worker の推論デバイス/実行バックエンドの選択。
+# - device: "auto" なら mps → cuda → cpu の順で使えるものを選ぶ
+# - backend: "pt"（PyTorchそのまま）/ "onnx" / "openvino"（CPU向けのエクスポート版）
+BACKENDS = ("pt", "onnx", "openvino")
+
+
+def select_device(preferred: str = "auto") -> str:
+    """使えるデバイスを返す。指定デバイスが使えない時は cpu にフォールバック"""
+    preferred = (preferred or "auto").lower()
+    try:
+        import torch  # type: ignore
+    except Exception:
+        return "cpu"
+
+    mps_ok = bool(getattr(torch.backends, "mps", None) and torch.backends.mps.is_available())
+    cuda_ok = bool(torch.cuda.is_available())
+
+    if preferred == "auto":
+        if mps_ok:
+            return "mps"
+        if cuda_ok:
+            return "cuda:0"
+        return "cpu"
+    if preferred == "mps" and not mps_ok:
+        print("⚠️ MPS が使えないため cpu で推論します")
+        return "cpu"
+    if preferred.startswith("cuda") and not cuda_ok:
+        print("⚠️ CUDA が使えないため cpu で推論します")
+        return "cpu"
+    return preferred
+
+
+def set_thread_env(num_threads: int) -> None:
+    """
+    OpenMP/BLAS のスレッド数。これらはライブラリの初期化時に一度だけ読むので、
+    torch/ultralytics を import する前に呼ぶ（0以下なら何もしない）
+    """
+    if num_threads <= 0:
+        return
+    os.environ.setdefault("OMP_NUM_THREADS", str(num_threads))
+    os.environ.setdefault("OPENBLAS_NUM_THREADS", str(num_threads))
+
+
+def configure_threads(num_threads: int) -> None:
+    """
+    CPU推論のスレッド数を制限する（0以下なら何もしない）。
+    PyTorch 分はここで設定する。ONNX Runtime / OpenVINO は環境変数を見ないので load_model(num_threads=) で渡す
+    """
+    if num_threads <= 0:
+        return
+    set_thread_env(num_threads)
+    try:
+        import torch  # type: ignore
+
+        torch.set_num_threads(num_threads)
+    except Exception:
+        pass
+
+
+# エクスポート版の入力形状。既定の export はバッチ1固定なので、バッチ推論できるよう可変(dynamic)にする。
+# 形状が変わったら別ファイルにして、古いバッチ1固定のエクスポートを使い回さない
+EXPORT_SHAPE_TAG = "dynamic"
+
+
+def exported_model_path(model_path: str, backend: str) -> str:
+    """エクスポート版の置き場所（Best Model.pt → Best Model_dynamic.onnx 等）"""
+    p = Path(model_path)
+    if backend == "onnx":
+        return str(p.with_name(f"{p.stem}_{EXPORT_SHAPE_TAG}.onnx"))
+    if backend == "openvino":
+        return str(p.with_name(f"{p.stem}_{EXPORT_SHAPE_TAG}_openvino_model"))
+    return model_path
+
+
+def _export(model_path: str, backend: str) -> Optional[str]:
+    from ultralytics import YOLO
+
+    target = exported_model_path(model_path, backend)
+    print(f"🔧 {backend} 形式（バッチ可変）にエクスポートします: {model_path} → {target}")
+    try:
+        out = YOLO(model_path).export(format=backend, dynamic=True)
+        if not out:
+            return None
+        # ultralytics は Best Model.onnx 等の固定名で出力するので、形状付きの名前に移す
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(str(out), target)
+    except Exception as e:
+        print(f"⚠️ {backend} エクスポート失敗: {e}")
+        return None
+    return target
+
+
+def _ultralytics_version() -> str:
+    try:
+        import ultralytics  # type: ignore
+
+        return str(getattr(ultralytics, "__version__", "?"))
+    except Exception:
+        return "?"
+
+
+def _limit_exported_threads(model, path: str, backend: str, num_threads: int) -> None:
+    """
+    ultralytics が作る ONNX Runtime セッション / OpenVINO のコンパイル済みモデルを、
+    スレッド数を指定して作り直す（どちらも OMP_NUM_THREADS 等の環境変数は見ない）。
+
+    ultralytics にはスレッド数を渡す公開の口が無いので、推論器（AutoBackend）の属性
+    （onnx: session / openvino: ov_compiled_model）を差し替える。属性が見つからない
+    （ultralytics の更新で名前が変わった等）時や、差し替え後の推論に失敗した時は警告を出して元のまま使う
+    """
+    if num_threads <= 0:
+        return
+    import numpy as np  # type: ignore
+
+    attr = {"onnx": "session", "openvino": "ov_compiled_model"}.get(backend)
+    if attr is None:
+        return
+    warmup = np.zeros((64, 64, 3), dtype=np.uint8)
+    try:
+        # 推論器（AutoBackend）は初回 predict で作られるので、小さい画像で1回通す
+        model.predict(warmup, device="cpu", verbose=False)
+        runtime = getattr(getattr(model, "predictor", None), "model", None)
+        original = getattr(runtime, attr, None)
+        if original is None:
+            print(
+                f"⚠️ {backend} の推論スレッド数を設定できません: ultralytics {_ultralytics_version()} の推論器に "
+                f"{attr} がありません（スレッド数はランタイムの既定のまま）"
+            )
+            return
+
+        if backend == "onnx":
+            import onnxruntime as ort  # type: ignore
+
+            opts = ort.SessionOptions()
+            opts.intra_op_num_threads = num_threads
+            opts.inter_op_num_threads = 1
+            replacement = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+        else:
+            import openvino as ov  # type: ignore
+
+            xml = next(Path(path).glob("*.xml"))
+            config = {"INFERENCE_NUM_THREADS": num_threads}
+            try:
+                config["PERFORMANCE_HINT"] = str(original.get_property("PERFORMANCE_HINT"))
+            except Exception:
+                pass
+            core = ov.Core()
+            replacement = core.compile_model(core.read_model(str(xml)), "CPU", config)
+
+        setattr(runtime, attr, replacement)
+        try:
+            # 差し替えた先で推論が通るかを確かめる（通らなければ元に戻す）
+            model.predict(warmup, device="cpu", verbose=False)
+        except Exception:
+            setattr(runtime, attr, original)
+            raise
+        print(f"ℹ️ {backend} の推論スレッド数: {num_threads}")
+    except Exception as e:
+        print(f"⚠️ {backend} のスレッド数を設定できませんでした（ultralytics {_ultralytics_version()}）: {e}")
+
+
+def load_model(
+    model_path: str,
+    backend: str = "pt",
+    device: str = "cpu",
+    *,
+    export_if_missing: bool = True,
+    num_threads: int = 0,
+) -> Tuple[object, str, str]:
+    """
+    モデルを読み込んで (model, 実際のbackend, 推論に使うdevice) を返す。
+    エクスポート版が無く/作れない時は pt にフォールバックする。
+    num_threads > 0 ならエクスポート版の推論スレッド数もそれに合わせる。
+    """
+    from ultralytics import YOLO
+
+    backend = (backend or "pt").lower()
+    if backend not in BACKENDS:
+        print(f"⚠️ 未対応のバックエンド {backend} のため pt を使います")
+        backend = "pt"
+
+    if backend != "pt":
+        path = exported_model_path(model_path, backend)
+        if not os.path.exists(path) and export_if_missing:
+            path = _export(model_path, backend) or path
+        if os.path.exists(path):
+            try:
+                # エクスポート版はCPU実行を前提にする
+                model = YOLO(path, task="detect")
+                _limit_exported_threads(model, path, backend, num_threads)
+                return model, backend, "cpu"
+            except Exception as e:
+                print(f"⚠️ {backend} モデルの読込に失敗したため pt を使います: {e}")
+        else:
+            print(f"⚠️ {path} が無いため pt を使います")
+
+    return YOLO(model_path), "pt", device
+
+
+def benchmark_backends(
+    model_path: str,
+    sample_image: str,
+    device: str,
+    *,
+    backends: Optional[List[str]] = None,
+    runs: int = 10,
+    conf: float = 0.5,
+) -> None:
+    """各バックエンドで sample_image を推論し、平均レイテンシを表示する"""
+    for name in backends or list(BACKENDS):
+        try:
+            model, actual, dev = load_model(model_path, name, device)
+        except Exception as e:
+            print(f"  ⏱ {name:<8} 読込失敗: {e}")
+            continue
+        if actual != name:
+            print(f"  ⏱ {name:<8} 利用不可（{actual} にフォールバック）")
+            continue
+        try:
+            # 1回目はウォームアップ（グラフ構築/メモリ確保）として除外
+            model.predict(sample_image, conf=conf, device=dev, verbose=False)
+            started = time.perf_counter()
+            for _ in range(max(1, runs)):
+                model.predict(sample_image, conf=conf, device=dev, verbose=False)
+            latency_ms = (time.perf_counter() - started) * 1000.0 / max(1, runs)
+            print(f"  ⏱ {name:<8} device={dev:<7} {latency_ms:8.1f} ms/枚")
+        except Exception as e:
+            print(f"  ⏱ {name:<8} 推論失敗: {e}")
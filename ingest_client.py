@@ -0,0 +1,505 @@
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urljoin
+
+try:
+    import requests  # type: ignore
+    from requests.adapters import HTTPAdapter  # type: ignore
+    from urllib3.util.retry import Retry  # type: ignore
+except Exception:
+    requests = None  # type: ignore
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class IngestClient:
+    """
+    クラウド(Render)の ingest API 用クライアント。
+
+    - requests.Session を共有して keep-alive で TLS 接続を使い回す
+    - 接続エラー/5xx/429 は指数バックオフで自動リトライ
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        *,
+        timeout: float = 10.0,
+        pool_size: int = 4,
+        retries: int = 3,
+        backoff_sec: float = 0.5,
+        log_errors: bool = True,
+    ):
+        if requests is None:
+            raise RuntimeError("requests is required for IngestClient")
+        self.base_url = base_url.rstrip("/") + "/"
+        self.token = token
+        self.timeout = timeout
+        self.log_errors = log_errors
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_sec,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=None,  # POSTもリトライする（ingest側は同名上書きなので冪等）
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"X-Ingest-Token": token})
+
+    def url(self, endpoint: str) -> str:
+        return urljoin(self.base_url, endpoint.lstrip("/"))
+
+    def post_file(self, endpoint: str, path: str, *, timeout: Optional[float] = None) -> bool:
+        """ファイルを multipart でアップロード。2xxなら True"""
+        try:
+            with open(path, "rb") as f:
+                files = {"file": (os.path.basename(path), f)}
+                r = self.session.post(self.url(endpoint), files=files, timeout=timeout or self.timeout)
+        except Exception as e:
+            if self.log_errors:
+                print(f"⚠️ アップロード例外: {os.path.basename(path)} ({e})")
+            return False
+        if r.status_code >= 300:
+            if self.log_errors:
+                print(f"⚠️ アップロード失敗: {os.path.basename(path)} ({r.status_code})")
+            return False
+        return True
+
+    def post_files(self, endpoint: str, paths: List[str], *, timeout: Optional[float] = None) -> Optional[Dict[str, bool]]:
+        """
+        複数ファイルを1つの multipart でアップロード（/api/ingest/images 用）。
+        戻り値はファイル名ごとの成否。サーバーが一括APIに未対応(404/405)なら None。
+        """
+        handles = []
+        try:
+            files = []
+            for path in paths:
+                f = open(path, "rb")
+                handles.append(f)
+                files.append(("file", (os.path.basename(path), f)))
+            r = self.session.post(self.url(endpoint), files=files, timeout=timeout or self.timeout)
+        except Exception as e:
+            if self.log_errors:
+                print(f"⚠️ 一括アップロード例外: {len(paths)}件 ({e})")
+            return {os.path.basename(p): False for p in paths}
+        finally:
+            for f in handles:
+                f.close()
+
+        if r.status_code in (404, 405):
+            return None
+        results = {os.path.basename(p): False for p in paths}
+        if r.status_code >= 300:
+            if self.log_errors:
+                print(f"⚠️ 一括アップロード失敗: {len(paths)}件 ({r.status_code})")
+            return results
+        try:
+            for item in r.json().get("results", []):
+                if item.get("filename") in results:
+                    results[item["filename"]] = item.get("status") == "ok"
+        except Exception:
+            pass
+        return results
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class TrackingDeltaSender:
+    """
+    tracking.csv の追記分だけを /api/ingest/tracking/delta へ送る。
+
+    - 送信済み位置(offset)を覚えておき、毎回そこから後ろの「改行で終わっている行」だけを送る
+    - 先頭行のハッシュを世代(generation)とし、ログが作り直されたら offset=0 から送り直す
+    - 409（位置ずれ）はサーバーが返す size から再開。再起動時は GET で受信済み位置を聞いてから再開する
+    - サーバーが差分APIに未対応(404/405)なら、更新時に全体を full_endpoint へ送る従来動作にする
+    """
+
+    HEAD_BYTES = 256
+
+    def __init__(
+        self,
+        client: IngestClient,
+        path: str,
+        *,
+        endpoint: str = "api/ingest/tracking/delta",
+        full_endpoint: str = "api/ingest/tracking",
+        max_chunk_bytes: int = 1024 * 1024,
+    ):
+        self.client = client
+        self.path = path
+        self.endpoint = endpoint
+        self.full_endpoint = full_endpoint
+        self.max_chunk_bytes = int(max_chunk_bytes)
+        self.delta_supported = True
+        self.bytes_sent = 0
+
+        self._generation: Optional[str] = None
+        self._head_hash: Optional[str] = None
+        self._rotations = 0
+        self._offset: Optional[int] = None  # None = サーバーの受信済み位置が不明
+        self._last_full_mtime: Optional[float] = None
+
+    def _read_head_hash(self) -> Optional[str]:
+        with open(self.path, "rb") as f:
+            head = f.read(self.HEAD_BYTES)
+        line_end = head.find(b"\n")
+        if line_end < 0:
+            return None  # 1行目が書き終わるまで待つ
+        return hashlib.sha1(head[: line_end + 1]).hexdigest()[:16]
+
+    def _request(self, method: str, **kwargs):
+        r = self.client.session.request(method, self.client.url(self.endpoint), timeout=self.client.timeout, **kwargs)
+        if r.status_code in (404, 405):
+            print("ℹ️ サーバーが差分取り込みに未対応のため tracking.csv を全体送信します")
+            self.delta_supported = False
+            return None
+        return r
+
+    def _resume_offset(self, size: int) -> Optional[int]:
+        r = self._request("GET")
+        if r is None or r.status_code >= 300:
+            return None
+        data = r.json()
+        if data.get("generation") != self._generation:
+            return 0
+        return min(int(data.get("size", 0)), size)
+
+    def _sync_full(self) -> bool:
+        mtime = os.path.getmtime(self.path)
+        if self._last_full_mtime == mtime:
+            return True
+        if not self.client.post_file(self.full_endpoint, self.path):
+            return False
+        self._last_full_mtime = mtime
+        self.bytes_sent += _file_size(self.path)
+        return True
+
+    def sync(self) -> bool:
+        """未送信の追記分を1回送る。送るものが無い/送れたら True"""
+        if not os.path.exists(self.path):
+            return True
+        try:
+            if not self.delta_supported:
+                return self._sync_full()
+
+            size = os.path.getsize(self.path)
+            head_hash = self._read_head_hash()
+            if head_hash is None:
+                return True
+            if head_hash != self._head_hash:
+                self._head_hash, self._rotations, self._offset = head_hash, 0, None
+            elif self._offset is not None and size < self._offset:
+                # 先頭は同じだが縮んだ（作り直し）→ 別世代として送り直す
+                self._rotations += 1
+                self._offset = 0
+            self._generation = self._head_hash if not self._rotations else f"{self._head_hash}-{self._rotations}"
+
+            if self._offset is None:
+                self._offset = self._resume_offset(size)
+                if self._offset is None:
+                    return self._sync_full() if not self.delta_supported else False
+            if size <= self._offset:
+                return True
+
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                chunk = f.read(self.max_chunk_bytes)
+            cut = chunk.rfind(b"\n") + 1
+            if cut <= 0:
+                return True  # 書きかけの行しか無い
+            chunk = chunk[:cut]
+
+            r = self._request(
+                "POST",
+                params={"generation": self._generation, "offset": self._offset},
+                data=chunk,
+                headers={"Content-Type": "text/csv"},
+            )
+            if r is None:
+                return self._sync_full()
+            if r.status_code == 409:
+                data = r.json()
+                self._offset = min(int(data.get("size", 0)), size) if data.get("generation") == self._generation else 0
+                return False
+            if r.status_code >= 300:
+                if self.client.log_errors:
+                    print(f"⚠️ 位置情報の差分送信失敗 ({r.status_code})")
+                return False
+            self._offset = int(r.json().get("size", self._offset + len(chunk)))
+            self.bytes_sent += len(chunk)
+            return True
+        except Exception as e:
+            if self.client.log_errors:
+                print(f"⚠️ 位置情報の差分送信例外: {e}")
+            return False
+
+
+class UploadLedger:
+    """
+    アップロード済みファイル名の追記専用ログ。再起動しても送信済み画像を送り直さない。
+    複数プロセスが同じファイルに追記しても、refresh() で他プロセスの追記分を取り込める。
+    追記と compact() は <path>.lock の flock で排他するので、書き直し中の追記が消えることは無い。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._names: Set[str] = set()
+        self._offset = 0
+        self._inode: Optional[int] = None
+        self._lock = threading.Lock()
+        Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+        self._lock_fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self.refresh()
+
+    @contextmanager
+    def _file_lock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _refresh_unlocked(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            # 他プロセスが compact() で書き直した
+            self._names.clear()
+            self._offset = 0
+            self._inode = st.st_ino
+        if st.st_size == self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        cut = chunk.rfind(b"\n") + 1
+        for line in chunk[:cut].decode("utf-8", errors="replace").splitlines():
+            if line:
+                self._names.add(line)
+        self._offset += cut
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._refresh_unlocked()
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._names
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            if name in self._names:
+                return
+            self._names.add(name)
+            # compact() の rename と重なると古いファイルへの追記になるので、flock の中で開く
+            with self._file_lock():
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(name + "\n")
+
+    def compact(self, keep: Set[str]) -> None:
+        """まだ存在するファイルの分だけ残してログを書き直す（起動時に1回）"""
+        with self._lock, self._file_lock():
+            # keep を作った後に他プロセスが追記した分は消さない
+            stale = self._names - keep
+            self._refresh_unlocked()
+            self._names -= stale
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for name in sorted(self._names):
+                    f.write(name + "\n")
+            os.replace(tmp_path, self.path)
+            st = os.stat(self.path)
+            self._inode, self._offset = st.st_ino, st.st_size
+
+
+class UploadQueue:
+    """
+    欠品画像のバックグラウンド送信。submit() は即座に戻るので推論ループがネットワークを待たない。
+
+    - 送信スレッドを workers 本立て、Sessionの接続プールを共有して並列送信
+    - batch_endpoint を指定すると、溜まっている画像を最大 batch_size 枚/batch_max_bytes まで
+      1リクエストにまとめて送る（サーバーが未対応なら1枚ずつの endpoint に切り替える）
+    - 送信済みは UploadLedger に記録。失敗した画像は次回の scan_pending() で再投入
+    - start_pending_scanner() で、送り漏れの定期スキャンも別スレッドで回せる
+    """
+
+    def __init__(
+        self,
+        client: IngestClient,
+        endpoint: str,
+        ledger: UploadLedger,
+        *,
+        workers: int = 4,
+        batch_endpoint: Optional[str] = None,
+        batch_size: int = 16,
+        batch_max_bytes: int = 8 * 1024 * 1024,
+    ):
+        self.client = client
+        self.endpoint = endpoint
+        self.ledger = ledger
+        self.batch_endpoint = batch_endpoint
+        self.batch_size = max(1, int(batch_size))
+        self.batch_max_bytes = int(batch_max_bytes)
+
+        self._queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self._inflight: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.uploaded = 0
+        self.failed = 0
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f"upload-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, path: str) -> bool:
+        """送信予約。送信済み/送信中なら False"""
+        name = os.path.basename(path)
+        if name in self.ledger:
+            return False
+        with self._lock:
+            if name in self._inflight:
+                return False
+            self._inflight.add(name)
+        self._queue.put((path, name))
+        return True
+
+    def _take_batch(self) -> List[Tuple[str, str]]:
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        if self.batch_endpoint is None:
+            return batch
+        total = _file_size(first[0])
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            size = _file_size(item[0])
+            if total + size > self.batch_max_bytes:
+                self._queue.put(item)  # 次のバッチへ回す
+                break
+            batch.append(item)
+            total += size
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._take_batch()
+            if not batch:
+                continue
+            try:
+                self._upload(batch)
+            except Exception as e:
+                print(f"⚠️ 送信スレッドエラー: {e}")
+                self.failed += len(batch)
+            finally:
+                with self._lock:
+                    for _, name in batch:
+                        self._inflight.discard(name)
+
+    def _upload(self, batch: List[Tuple[str, str]]) -> None:
+        batch = [(path, name) for path, name in batch if os.path.exists(path)]
+        if not batch:
+            return
+
+        results: Optional[Dict[str, bool]] = None
+        if self.batch_endpoint is not None and len(batch) > 1:
+            results = self.client.post_files(self.batch_endpoint, [path for path, _ in batch])
+            if results is None:
+                print("ℹ️ サーバーが一括アップロードに未対応のため1枚ずつ送信します")
+                self.batch_endpoint = None
+        if results is None:
+            results = {name: self.client.post_file(self.endpoint, path) for path, name in batch}
+
+        for _, name in batch:
+            if results.get(name):
+                self.ledger.add(name)
+                self.uploaded += 1
+            else:
+                self.failed += 1
+
+    def scan_pending(self, directory: str, *, prefix: str = "", suffix: str = ".jpg", min_age_sec: float = 0.0) -> int:
+        """未送信の画像をまとめて送信予約する。min_age_sec より新しいファイルは他の送信に任せる"""
+        self.ledger.refresh()
+        now = time.time()
+        queued = 0
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return 0
+        for name in names:
+            if not (name.startswith(prefix) and name.endswith(suffix)):
+                continue
+            if name in self.ledger:
+                continue
+            path = os.path.join(directory, name)
+            if min_age_sec > 0:
+                # rename では mtime が変わらないので、置かれた時刻は ctime で見る
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - max(st.st_mtime, st.st_ctime) < min_age_sec:
+                    continue
+            if self.submit(path):
+                queued += 1
+        return queued
+
+    def start_pending_scanner(self, directory: str, interval_sec: float, **scan_kwargs) -> threading.Thread:
+        def run() -> None:
+            while not self._stop.is_set():
+                try:
+                    self.scan_pending(directory, **scan_kwargs)
+                except Exception as e:
+                    print(f"⚠️ 送信待ちスキャンエラー: {e}")
+                self._stop.wait(interval_sec)
+
+        t = threading.Thread(target=run, name="upload-scanner", daemon=True)
+        t.start()
+        return t
+
+    def close(self, wait: bool = True) -> None:
+        """wait=True なら予約済みの送信が終わるまで待ってから止める"""
+        if wait:
+            while True:
+                with self._lock:
+                    if not self._inflight:
+                        break
+                time.sleep(0.1)
+        self._stop.set()
+        if wait:
+            for t in self._threads:
+                t.join()
+        self.client.close()
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+
+class LeaderElection:
+    """
+    ロックファイルの flock で、複数のプロセス（Gunicornのワーカー）から1つだけをリーダーに選ぶ。
+
+    - 各プロセスは retry_sec ごとに排他ロック(LOCK_NB)を試し、取れたプロセスがリーダーになって on_elected を呼ぶ
+    - リーダーはロックを持ったまま終わらない。プロセスが落ちるとカーネルがロックを外すので、
+      他のプロセスが次の試行で引き継ぐ（ハートビートやタイムアウトの調整は要らない）
+    - on_elected が例外で落ちたり戻ったりしたら、ロックを手放してから（倍々で最大 backoff_max_sec）待って選挙に戻る。
+      監視スレッドだけが死んでプロセスは生きている時も、他のプロセスが引き継げる
+    - ロックファイルにはリーダーの pid/ホスト/就任時刻を書いておき、どのプロセスからでも leader() で読める
+    - flock は fork 後の子にも引き継がれるので、Gunicorn の --preload（親でimport）とは併用しない
+    """
+
+    # この時間より長く動いていたら、落ちても「続けて失敗した」とはみなさずバックオフを戻す
+    HEALTHY_RUN_SEC = 60.0
+
+    def __init__(self, path: str, *, retry_sec: float = 1.0, backoff_max_sec: float = 30.0):
+        self.path = path
+        self.retry_sec = float(retry_sec)
+        self.backoff_max_sec = float(backoff_max_sec)
+        Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+
+        self._fd: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.elected_at: Optional[float] = None
+        self.failures = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return self._fd is not None
+
+    def _try_acquire(self) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.elected_at = time.time()
+        info = {"pid": os.getpid(), "host": socket.gethostname(), "since": self.elected_at}
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, json.dumps(info).encode("utf-8"), 0)
+        self._fd = fd
+        return True
+
+    def _resign(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            os.close(fd)  # close で flock も外れる
+
+    def start(self, on_elected: Callable[[], object]) -> None:
+        """リーダーになるまで裏で試し続け、なったら（そのスレッドで）on_elected を呼ぶ。抜けたら辞任してやり直す"""
+        if self._thread is not None:
+            return
+
+        def run() -> None:
+            backoff = 0.0
+            while not self._stop.is_set():
+                try:
+                    acquired = self._try_acquire()
+                except OSError as e:
+                    print(f"⚠️ リーダーロックの取得に失敗: {e}", flush=True)
+                    acquired = False
+                if not acquired:
+                    self._stop.wait(self.retry_sec)
+                    continue
+
+                print(f"👑 監視のリーダーになりました (pid {os.getpid()})", flush=True)
+                started = time.monotonic()
+                try:
+                    on_elected()
+                    print(f"⚠️ 監視スレッドが終了しました (pid {os.getpid()})", flush=True)
+                except Exception as e:
+                    print(f"⚠️ 監視スレッドが異常終了しました (pid {os.getpid()}): {e!r}", flush=True)
+                self.failures += 1
+                self._resign()
+
+                if time.monotonic() - started >= self.HEALTHY_RUN_SEC:
+                    backoff = 0.0
+                backoff = min(self.backoff_max_sec, max(self.retry_sec, backoff * 2))
+                print(f"🔁 リーダーを降りて {backoff:g} 秒後に選挙に戻ります", flush=True)
+                self._stop.wait(backoff)
+
+        self._thread = threading.Thread(target=run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def _held_by_other(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False  # 取れた＝誰も持っていない（close で外れる）
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+
+    def leader(self) -> Optional[dict]:
+        """現在のリーダーの情報。誰もロックを持っていなければ None"""
+        if not self.is_leader and not self._held_by_other():
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}  # 就任直後で書き込み途中
+
+    def stop(self) -> None:
+        """試行をやめ、リーダーならロックを手放す"""
+        self._stop.set()
+        self._resign()
@@ -1,8 +1,16 @@
 from __future__ import annotations
 
 import os
+import time
 from dataclasses import dataclass
-from typing import Optional
+from typing import Dict, Optional
+
+try:
+    import numpy as np  # type: ignore
+except Exception:
+    np = None  # type: ignore
+
+ENGINES = ("auto", "pillow", "numpy")
 
 
 @dataclass(frozen=True)
@@ -16,6 +24,7 @@ class MapPreprocessConfig:
     edge: bool = True
     edge_thicken_px: int = 1
     keep_raw: bool = False
+    engine: str = "auto"
 
 
 def _env_int(name: str, default: int, *, min_v: int, max_v: int) -> int:
@@ -50,6 +59,7 @@ def load_config_from_env() -> MapPreprocessConfig:
       - MAP_EDGE=1/0（輪郭線のみ描く）
       - MAP_EDGE_THICKEN_PX=0..6（輪郭を太くする）
       - MAP_KEEP_RAW=1/0（rawを .raw.png に退避）
+      - MAP_PREPROCESS_ENGINE=auto/pillow/numpy（auto: NumPyがあれば numpy。出力はどちらも同じ）
     """
     enabled = _env_bool("MAP_PREPROCESS", True)
     occ_threshold = _env_int("MAP_OCC_THRESHOLD", 60, min_v=0, max_v=255)
@@ -60,6 +70,9 @@ def load_config_from_env() -> MapPreprocessConfig:
     edge = _env_bool("MAP_EDGE", True)
     edge_thicken_px = _env_int("MAP_EDGE_THICKEN_PX", 1, min_v=0, max_v=6)
     keep_raw = _env_bool("MAP_KEEP_RAW", False)
+    engine = (os.environ.get("MAP_PREPROCESS_ENGINE") or "auto").lower()
+    if engine not in ENGINES:
+        engine = "auto"
     return MapPreprocessConfig(
         enabled=enabled,
         occ_threshold=occ_threshold,
@@ -70,97 +83,256 @@ def load_config_from_env() -> MapPreprocessConfig:
         edge=edge,
         edge_thicken_px=edge_thicken_px,
         keep_raw=keep_raw,
+        engine=engine,
     )
 
 
-def preprocess_map_png(
-    in_path: str,
-    out_path: str,
-    *,
-    config: Optional[MapPreprocessConfig] = None,
-) -> bool:
+def _px_to_filter_size(px: int) -> int:
+    # PillowのMin/MaxFilterは奇数サイズ
+    if px <= 0:
+        return 0
+    return px * 2 + 1
+
+
+def _occ_lut(config: MapPreprocessConfig) -> list:
     """
-    in_path のPNGを読み、見やすい線画っぽいPNGとして out_path に保存する。
-    成功したら True、前処理をスキップした/できなかったら False。
+    occupied(壁/棚など)をマスク化する変換表: occupied=255, background=0
+    ROS map.pgm だと occupied=0, unknown=205, free=254/255 が多い。
+    unknownは“白寄せ”にして視認性優先（必要なら閾値調整）。
     """
-    if config is None:
-        config = load_config_from_env()
-    if not config.enabled:
-        return False
+    occ_thr = int(config.occ_threshold)
+    free_thr = int(config.free_threshold)
+    lut = []
+    for p in range(256):
+        if p <= occ_thr:
+            lut.append(255)
+        elif p >= free_thr:
+            lut.append(0)
+        else:
+            lut.append(0)  # unknown -> 背景扱い（白）
+    return lut
 
-    try:
-        from PIL import Image, ImageChops, ImageFilter, ImageOps  # type: ignore
-    except Exception:
-        # 依存が無い環境では無加工で通す
-        return False
 
-    if config.keep_raw and in_path == out_path:
-        # 同一パスで上書きするケースを想定（raw退避）
-        raw_path = f"{out_path}.raw.png"
-        try:
-            Image.open(in_path).save(raw_path)
-        except Exception:
-            pass
+class _StageTimer:
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def lap(self, name: str) -> None:
+        now = time.perf_counter()
+        self.stages[name] = self.stages.get(name, 0.0) + (now - self._last) * 1000.0
+        self._last = now
 
-    img = Image.open(in_path)
-    gray = img.convert("L")
+
+def _run_pillow(gray, config: MapPreprocessConfig, timer: _StageTimer):
+    from PIL import ImageChops, ImageFilter, ImageOps  # type: ignore
 
     # 先にメディアンでゴマ塩ノイズを軽減（SLAMの占有格子でよく出る）
     if config.median_size >= 3 and config.median_size % 2 == 1:
         gray = gray.filter(ImageFilter.MedianFilter(size=config.median_size))
+    timer.lap("median")
 
-    # occupied(壁/棚など)をマスク化: occupied=255, background=0
-    # ROS map.pgm だと occupied=0, unknown=205, free=254/255 が多い。
-    # unknownは“白寄せ”にして視認性優先（必要なら閾値調整）。
-    occ_thr = int(config.occ_threshold)
-    free_thr = int(config.free_threshold)
-
-    def to_occ(p: int) -> int:
-        if p <= occ_thr:
-            return 255
-        if p >= free_thr:
-            return 0
-        return 0  # unknown -> 背景扱い（白）
-
-    occ = gray.point(to_occ, mode="L")
-
-    def px_to_filter_size(px: int) -> int:
-        # PillowのMin/MaxFilterは奇数サイズ
-        if px <= 0:
-            return 0
-        return px * 2 + 1
+    occ = gray.point(_occ_lut(config), mode="L")
+    timer.lap("threshold")
 
     # 小さいゴミを落とす（opening）
-    open_size = px_to_filter_size(int(config.open_px))
+    open_size = _px_to_filter_size(int(config.open_px))
     if open_size >= 3:
         occ = occ.filter(ImageFilter.MinFilter(size=open_size))  # erode
         occ = occ.filter(ImageFilter.MaxFilter(size=open_size))  # dilate
+    timer.lap("open")
 
     # 壁の切れ目を繋ぐ（closing）
-    close_size = px_to_filter_size(int(config.close_px))
+    close_size = _px_to_filter_size(int(config.close_px))
     if close_size >= 3:
         occ = occ.filter(ImageFilter.MaxFilter(size=close_size))  # dilate
         occ = occ.filter(ImageFilter.MinFilter(size=close_size))  # erode
+    timer.lap("close")
 
     if config.edge:
         # 輪郭線だけにする: (dilate - erode)
-        edge_size = px_to_filter_size(1)
+        edge_size = _px_to_filter_size(1)
         dil = occ.filter(ImageFilter.MaxFilter(size=edge_size))
         ero = occ.filter(ImageFilter.MinFilter(size=edge_size))
         edges = ImageChops.difference(dil, ero)
 
-        thicken_size = px_to_filter_size(int(config.edge_thicken_px))
+        thicken_size = _px_to_filter_size(int(config.edge_thicken_px))
         if thicken_size >= 3:
             edges = edges.filter(ImageFilter.MaxFilter(size=thicken_size))
+        timer.lap("edge")
 
         # 白背景に黒線
         out = ImageOps.invert(edges)
     else:
         # occupiedを黒ベタに（白背景）
         out = ImageOps.invert(occ)
+    timer.lap("invert")
+    return out
+
+
+# --- NumPy版（Pillow版と同じ結果になるよう、端は Pillow と同じく端の画素を延長して扱う） ---
+
+def _np_window_reduce(a, k: int, axis: int, op):
+    """axis 方向の幅 2k+1 の窓で op（np.minimum/np.maximum）を取る"""
+    if k <= 0:
+        return a
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (k, k)
+    p = np.pad(a, pad, mode="edge")
+    n = a.shape[axis]
+    if axis == 0:
+        out = p[0:n].copy()
+        for d in range(1, 2 * k + 1):
+            op(out, p[d:d + n], out=out)
+    else:
+        out = p[:, 0:n].copy()
+        for d in range(1, 2 * k + 1):
+            op(out, p[:, d:d + n], out=out)
+    return out
+
+
+def _np_rank_filter(a, size: int, op):
+    # 正方窓の min/max は行方向→列方向の2回に分解できる（O(size^2) → O(2*size)）
+    k = size // 2
+    return _np_window_reduce(_np_window_reduce(a, k, 1, op), k, 0, op)
+
+
+def _np_med3(a, b, c):
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+
+def _np_median3(a):
+    """
+    3x3 メディアン（既定設定）は比較だけで求める:
+    縦3画素を並べ替えて(lo, mid, hi)にすると、9画素の中央値 = med3(横3つのloの最大, midの中央値, hiの最小)
+    """
+    p = np.pad(a, 1, mode="edge")
+    top, center, bottom = p[:-2], p[1:-1], p[2:]
+    lo = np.minimum(np.minimum(top, center), bottom)
+    hi = np.maximum(np.maximum(top, center), bottom)
+    mid = _np_med3(top, center, bottom)
+    w = a.shape[1]
+    lo_max = np.maximum(np.maximum(lo[:, 0:w], lo[:, 1:w + 1]), lo[:, 2:w + 2])
+    hi_min = np.minimum(np.minimum(hi[:, 0:w], hi[:, 1:w + 1]), hi[:, 2:w + 2])
+    mid_med = _np_med3(mid[:, 0:w], mid[:, 1:w + 1], mid[:, 2:w + 2])
+    return _np_med3(lo_max, mid_med, hi_min)
+
+
+def _np_median_filter(a, size: int, *, rows_per_chunk: int = 256):
+    """size x size のメディアン。大きな地図でもメモリを食わないよう行ブロックごとに処理する"""
+    if size == 3:
+        return _np_median3(a)
+    k = size // 2
+    p = np.pad(a, k, mode="edge")
+    h, w = a.shape
+    mid = (size * size) // 2
+    out = np.empty_like(a)
+    for top in range(0, h, rows_per_chunk):
+        rows = min(rows_per_chunk, h - top)
+        stack = np.stack([
+            p[top + dy:top + dy + rows, dx:dx + w]
+            for dy in range(size)
+            for dx in range(size)
+        ])
+        out[top:top + rows] = np.partition(stack, mid, axis=0)[mid]
+    return out
+
+
+def _run_numpy(gray, config: MapPreprocessConfig, timer: _StageTimer):
+    from PIL import Image  # type: ignore
+
+    a = np.asarray(gray, dtype=np.uint8)
+    if config.median_size >= 3 and config.median_size % 2 == 1:
+        a = _np_median_filter(a, config.median_size)
+    timer.lap("median")
+
+    occ = np.asarray(_occ_lut(config), dtype=np.uint8)[a]
+    timer.lap("threshold")
+
+    open_size = _px_to_filter_size(int(config.open_px))
+    if open_size >= 3:
+        occ = _np_rank_filter(occ, open_size, np.minimum)
+        occ = _np_rank_filter(occ, open_size, np.maximum)
+    timer.lap("open")
+
+    close_size = _px_to_filter_size(int(config.close_px))
+    if close_size >= 3:
+        occ = _np_rank_filter(occ, close_size, np.maximum)
+        occ = _np_rank_filter(occ, close_size, np.minimum)
+    timer.lap("close")
+
+    if config.edge:
+        edge_size = _px_to_filter_size(1)
+        # dilate >= erode なので差の絶対値は単純な引き算でよい
+        edges = _np_rank_filter(occ, edge_size, np.maximum) - _np_rank_filter(occ, edge_size, np.minimum)
+        thicken_size = _px_to_filter_size(int(config.edge_thicken_px))
+        if thicken_size >= 3:
+            edges = _np_rank_filter(edges, thicken_size, np.maximum)
+        timer.lap("edge")
+        out = 255 - edges
+    else:
+        out = 255 - occ
+    timer.lap("invert")
+    # 2次元の uint8 は mode を指定しなくても L になる（mode 引数は Pillow で非推奨）
+    assert out.dtype == np.uint8 and out.ndim == 2
+    return Image.fromarray(out)
+
+
+def preprocess_map_png(
+    in_path: str,
+    out_path: str,
+    *,
+    config: Optional[MapPreprocessConfig] = None,
+    report: Optional[dict] = None,
+) -> bool:
+    """
+    in_path のPNGを読み、見やすい線画っぽいPNGとして out_path に保存する。
+    成功したら True、前処理をスキップした/できなかったら False。
+    report に dict を渡すと、使ったエンジンと段階ごとの処理時間(ms)を書き込む。
+    """
+    if config is None:
+        config = load_config_from_env()
+    if not config.enabled:
+        return False
+
+    try:
+        from PIL import Image  # type: ignore
+    except Exception:
+        # 依存が無い環境では無加工で通す
+        return False
+
+    engine = config.engine
+    if engine == "auto":
+        engine = "numpy" if np is not None else "pillow"
+    elif engine == "numpy" and np is None:
+        engine = "pillow"
+
+    timer = _StageTimer()
+    if config.keep_raw and in_path == out_path:
+        # 同一パスで上書きするケースを想定（raw退避）
+        raw_path = f"{out_path}.raw.png"
+        try:
+            Image.open(in_path).save(raw_path)
+        except Exception:
+            pass
+
+    img = Image.open(in_path)
+    gray = img.convert("L")
+    timer.lap("decode")
+
+    if engine == "numpy":
+        out = _run_numpy(gray, config, timer)
+    else:
+        out = _run_pillow(gray, config, timer)
 
     # 完全白は眩しいので、うっすらオフホワイトに寄せても良いが、ここではシンプルに白固定
     out = out.convert("RGB")
-    out.save(out_path)
-    return True
+    # out_path が .tmp 等でも PNG で書く
+    out.save(out_path, format="PNG")
+    timer.lap("encode")
 
+    if report is not None:
+        report["engine"] = engine
+        report["stages_ms"] = {name: round(ms, 1) for name, ms in timer.stages.items()}
+        report["total_ms"] = round(sum(timer.stages.values()), 1)
+    return True
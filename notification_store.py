@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    photo_time REAL NOT NULL,
+    area TEXT,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notifications_photo_time ON notifications (photo_time);
+CREATE INDEX IF NOT EXISTS notifications_area ON notifications (area, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class NotificationStore:
+    """
+    通知の保存先（SQLite, WAL）。
+
+    - id は AUTOINCREMENT なので、削除や再起動をまたいでも戻らない（since カーソルや Last-Event-ID がそのまま使える）
+    - 同じファイルを複数の Gunicorn ワーカーが開いて読める。書くのは監視スレッドを動かしている1プロセスだけ
+    - 件数が max_entries を超えるか、撮影時刻が max_age_sec より古くなったものは消す。
+      消した最大の id を floor_id として残し、それより前を since に渡されたら途切れとして扱わせる
+      （since == floor_id は消えた分まで読み終えているので続きから返せる）
+    - clear() は reset_count を進める（ETag やストリームがリセットに気付けるように）
+    """
+
+    def __init__(self, path: str, *, max_entries: int = 10000, max_age_sec: float = 0.0):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        self.max_age_sec = float(max_age_sec)
+        Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+
+    def _meta_unlocked(self, key: str) -> int:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _set_meta_unlocked(self, key: str, value: int) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, int(value)))
+
+    def _last_id_unlocked(self) -> int:
+        row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'notifications'").fetchone()
+        return int(row[0]) if row else 0
+
+    @staticmethod
+    def _decode(row: Tuple[int, str]) -> dict:
+        entry_id, payload = row
+        return {"id": int(entry_id), **json.loads(payload)}
+
+    def state(self) -> Tuple[int, int, int]:
+        """(reset_count, 最新の id, floor_id)。他のワーカーが書いた分もここで見える"""
+        with self._lock:
+            return (
+                self._meta_unlocked("reset_count"),
+                self._last_id_unlocked(),
+                self._meta_unlocked("floor_id"),
+            )
+
+    def add(self, msg: dict, *, photo_time: Optional[float] = None) -> dict:
+        """通知を保存して id 付きで返す（上限を超えたら古い順に消す）"""
+        payload = json.dumps(msg, ensure_ascii=False)
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO notifications (photo_time, area, payload) VALUES (?, ?, ?)",
+                (float(photo_time if photo_time is not None else time.time()), msg.get("area"), payload),
+            )
+            # 件数はキャッシュしない（他のワーカーの clear() や追加が見えなくなる）。
+            # 書き込みトランザクションの中で数えるので、上限の判定は常に全ワーカーの最新の件数
+            count = self._conn.execute("SELECT COUNT(*) FROM notifications").fetchone()[0]
+            if count > self.max_entries:
+                self._prune_unlocked()
+            return {"id": int(cur.lastrowid), **msg}
+
+    def _prune_unlocked(self) -> None:
+        # 毎回削除が走らないよう、上限の9割まで減らす
+        keep = max(1, self.max_entries * 9 // 10)
+        row = self._conn.execute(
+            "SELECT id FROM notifications ORDER BY id DESC LIMIT 1 OFFSET ?", (keep,)
+        ).fetchone()
+        if row is not None:
+            self._drop_through_unlocked(int(row[0]))
+
+    def _drop_through_unlocked(self, max_id: int) -> None:
+        self._conn.execute("DELETE FROM notifications WHERE id <= ?", (max_id,))
+        if max_id > self._meta_unlocked("floor_id"):
+            self._set_meta_unlocked("floor_id", max_id)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """撮影時刻が max_age_sec より古い通知を消して、消した件数を返す（max_age_sec<=0 なら何もしない）"""
+        if self.max_age_sec <= 0:
+            return 0
+        cutoff = (now if now is not None else time.time()) - self.max_age_sec
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT MAX(id) FROM notifications WHERE photo_time < ?", (cutoff,)
+            ).fetchone()
+            if row is None or row[0] is None:
+                return 0
+            # since の途切れ判定は floor_id 以下が全部消えている前提なので、期限切れの最大 id 以下をまとめて消す
+            before = self._conn.total_changes
+            self._drop_through_unlocked(int(row[0]))
+            return self._conn.total_changes - before
+
+    def latest(self, limit: int, *, area: Optional[str] = None) -> List[dict]:
+        """新しい順に最大 limit 件"""
+        with self._lock:
+            if area is None:
+                rows = self._conn.execute(
+                    "SELECT id, payload FROM notifications ORDER BY id DESC LIMIT ?", (int(limit),)
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT id, payload FROM notifications WHERE area = ? ORDER BY id DESC LIMIT ?",
+                    (area, int(limit)),
+                ).fetchall()
+        return [self._decode(r) for r in rows]
+
+    def after(self, last_id: int, limit: int, *, area: Optional[str] = None) -> List[dict]:
+        """last_id より新しい通知を古い順に最大 limit 件"""
+        with self._lock:
+            if area is None:
+                rows = self._conn.execute(
+                    "SELECT id, payload FROM notifications WHERE id > ? ORDER BY id LIMIT ?",
+                    (int(last_id), int(limit)),
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT id, payload FROM notifications WHERE area = ? AND id > ? ORDER BY id LIMIT ?",
+                    (area, int(last_id), int(limit)),
+                ).fetchall()
+        return [self._decode(r) for r in rows]
+
+    def clear(self) -> None:
+        """全件消して reset_count を進める（デモ用リセット）"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM notifications")
+            # id を1つ空けて floor_id をそこまで上げる。リセット前の id（追いついていたクライアントの
+            # since == 最新 id も含む）は全部 floor_id 未満になり、途切れとして扱われる
+            floor_id = self._last_id_unlocked() + 1
+            self._conn.execute("DELETE FROM sqlite_sequence WHERE name = 'notifications'")
+            self._conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('notifications', ?)", (floor_id,))
+            self._set_meta_unlocked("floor_id", floor_id)
+            self._set_meta_unlocked("reset_count", self._meta_unlocked("reset_count") + 1)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
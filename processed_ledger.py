@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Sequence, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (
+    name TEXT PRIMARY KEY,
+    photo_time REAL NOT NULL,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_photo_time ON processed (photo_time);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# SQLiteのバインド変数上限（古いビルドは999）に収まるように分割する
+_QUERY_CHUNK = 500
+
+
+class ProcessedLedger:
+    """
+    通知済み画像の台帳（SQLite）。
+
+    - ファイル名と撮影時刻をキーに記録するので、再起動しても同じ画像を再処理しない
+    - 件数が max_entries を超えたら撮影時刻の古い順に削除し、削除した最大時刻を
+      high-water mark として残す。それ以下の時刻の画像は「処理済み」とみなす
+      （全クリアしないので、あふれても通知が重複しない）
+    - メモリには件数しか持たない
+    """
+
+    def __init__(self, path: str, *, max_entries: int = 5000):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._count = self._conn.execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+            self._high_water_mark = self._read_hwm_unlocked()
+
+    def _read_hwm_unlocked(self) -> float:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'high_water_mark'").fetchone()
+        return float(row[0]) if row else float("-inf")
+
+    @property
+    def high_water_mark(self) -> float:
+        return self._high_water_mark
+
+    def __len__(self) -> int:
+        return self._count
+
+    def filter_unprocessed(self, items: Sequence[Tuple[str, float]]) -> List[Tuple[str, float]]:
+        """(ファイル名, 撮影時刻) のうち未処理のものだけを返す（順序は維持）"""
+        with self._lock:
+            hwm = self._high_water_mark
+            candidates = [(name, t) for name, t in items if t > hwm]
+            done = set()
+            for i in range(0, len(candidates), _QUERY_CHUNK):
+                chunk = [name for name, _ in candidates[i : i + _QUERY_CHUNK]]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT name FROM processed WHERE name IN ({placeholders})", chunk
+                )
+                done.update(r[0] for r in rows)
+        return [(name, t) for name, t in candidates if name not in done]
+
+    def is_processed(self, name: str, photo_time: float) -> bool:
+        return not self.filter_unprocessed([(name, photo_time)])
+
+    def mark_processed(self, entries: Iterable[Tuple[str, float]]) -> None:
+        """処理済みとして記録する（上限を超えたら古い順に間引く）"""
+        now = time.time()
+        rows = [(name, float(t), now) for name, t in entries]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO processed (name, photo_time, processed_at) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._count += self._conn.total_changes - before
+            if self._count > self.max_entries:
+                self._prune_unlocked()
+
+    def _prune_unlocked(self) -> None:
+        # 毎回削除が走らないよう、上限の9割まで減らす
+        keep = max(1, self.max_entries * 9 // 10)
+        drop = self._count - keep
+        row = self._conn.execute(
+            "SELECT MAX(photo_time) FROM ("
+            " SELECT photo_time FROM processed ORDER BY photo_time LIMIT ?"
+            ")",
+            (drop,),
+        ).fetchone()
+        if row is None or row[0] is None:
+            return
+        cutoff = float(row[0])
+        # 同時刻の取りこぼしが無いよう、cutoff以下はまとめて消して high-water mark で覆う
+        cur = self._conn.execute("DELETE FROM processed WHERE photo_time <= ?", (cutoff,))
+        self._count -= cur.rowcount
+        if cutoff > self._high_water_mark:
+            self._high_water_mark = cutoff
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('high_water_mark', ?)",
+                (cutoff,),
+            )
+
+    def reload(self) -> None:
+        """他のプロセスが書き換えた後に、件数と high-water mark を読み直す"""
+        with self._lock:
+            self._count = self._conn.execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+            self._high_water_mark = self._read_hwm_unlocked()
+
+    def clear(self) -> None:
+        """台帳を空にする（デモ用リセット）"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM processed")
+            self._conn.execute("DELETE FROM meta WHERE key = 'high_water_mark'")
+            self._count = 0
+            self._high_water_mark = float("-inf")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+class PeriodicTask:
+    """
+    interval_sec ごとに func を自分専用のスレッドで実行する。
+
+    - 前回が長引いて予定時刻を過ぎた分は詰めて実行せず、遅れ(lag)として記録する
+    - timeout_sec を超えて終わらない実行は TaskScheduler の監視スレッドが検出し、on_timeout を呼ぶ
+      （SSH接続を閉じる等でブロックしている処理を解放する用途。他のタスクは影響を受けない）
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], object],
+        interval_sec: float,
+        *,
+        timeout_sec: Optional[float] = None,
+        on_timeout: Optional[Callable[[], object]] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.interval_sec = float(interval_sec)
+        self.timeout_sec = timeout_sec
+        self.on_timeout = on_timeout
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._running_since: Optional[float] = None
+        self._timed_out = False
+
+        # 計測値（TaskScheduler.report() で表示）
+        self.runs = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.last_duration_sec = 0.0
+        self.max_duration_sec = 0.0
+        self.last_lag_sec = 0.0
+        self.max_lag_sec = 0.0
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f"task-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        scheduled = time.monotonic()
+        behind = 0.0
+        while not self._stop.is_set():
+            started = time.monotonic()
+            lag = max(0.0, started - scheduled) + behind
+            self.last_lag_sec = lag
+            self.max_lag_sec = max(self.max_lag_sec, lag)
+
+            self._timed_out = False
+            self._running_since = started
+            try:
+                self.func()
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️ タスクエラー [{self.name}]: {e}")
+            finally:
+                self._running_since = None
+            duration = time.monotonic() - started
+            self.runs += 1
+            self.last_duration_sec = duration
+            self.max_duration_sec = max(self.max_duration_sec, duration)
+
+            scheduled += self.interval_sec
+            now = time.monotonic()
+            behind = 0.0
+            if scheduled < now:
+                behind = now - scheduled  # 遅れた分は飛ばし、次回の遅れとして数える
+                scheduled = now
+            self._stop.wait(scheduled - now)
+
+    def check_timeout(self, now: float) -> bool:
+        """実行中で timeout_sec を超えていたら（1回の実行につき1度だけ）on_timeout を呼ぶ"""
+        since = self._running_since
+        if self.timeout_sec is None or since is None or self._timed_out:
+            return False
+        if now - since < self.timeout_sec:
+            return False
+        self._timed_out = True
+        self.timeouts += 1
+        print(f"⏰ タスクタイムアウト [{self.name}]: {now - since:.1f}秒経過")
+        if self.on_timeout is not None:
+            try:
+                self.on_timeout()
+            except Exception as e:
+                print(f"⚠️ タイムアウト処理エラー [{self.name}]: {e}")
+        return True
+
+
+class TaskScheduler:
+    """PeriodicTask をまとめて起動/停止し、タイムアウト監視と遅れの表示を受け持つ"""
+
+    def __init__(self, tasks: List[PeriodicTask], *, watchdog_interval_sec: float = 0.5):
+        self.tasks = tasks
+        self.watchdog_interval_sec = float(watchdog_interval_sec)
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        for task in self.tasks:
+            task.start()
+        self._watchdog = threading.Thread(target=self._watch, name="task-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.watchdog_interval_sec):
+            now = time.monotonic()
+            for task in self.tasks:
+                task.check_timeout(now)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        for task in self.tasks:
+            task.stop()
+        deadline = time.monotonic() + timeout
+        for task in self.tasks:
+            task.join(max(0.0, deadline - time.monotonic()))
+
+    def report(self) -> None:
+        for t in self.tasks:
+            print(
+                f"⏱ [{t.name}] {t.runs}回 所要 {t.last_duration_sec * 1000:.0f}ms (最大 {t.max_duration_sec * 1000:.0f}ms) "
+                f"遅れ {t.last_lag_sec * 1000:.0f}ms (最大 {t.max_lag_sec * 1000:.0f}ms) "
+                f"エラー {t.errors}回 タイムアウト {t.timeouts}回"
+            )
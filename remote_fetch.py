@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import json
+import os
+import stat
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from robot_link import RobotLink
+
+JPEG_EOI = b"\xff\xd9"
+
+
+def _write_json_atomic(path: str, data: dict) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class RemoteImageFetcher:
+    """
+    ロボット側の画像ディレクトリから新着だけを取ってくる。
+
+    - 毎回はディレクトリの stat だけ。mtime が変わった時（と、その次の1回）だけ SFTP listdir_attr で一覧を取る
+      （SFTPのmtimeは秒単位なので、同じ秒に追加されたファイルを次の周回で拾い直す）
+    - (mtime, ファイル名) のカーソルより新しいものだけを新着とみなす。カーソルは cursor_path に保存するので、
+      再起動しても処理済みの画像を取り直さない
+    - 取得に失敗したファイルも試行回数と一緒にカーソルファイルへ保存し、取れるまで（ロボット側から消えるまで）再試行する。
+      MAX_ATTEMPTS 回続けて失敗したものは、以降 full_rescan_sec ごとの全件確認の時だけ試す
+    - 直近に取得したファイル名も RECENT_NAMES 件まで保存する。一覧の最大 mtime がカーソルより古い
+      （ロボットの時計が戻った）時はカーソルを捨てて一覧を見直し、取得済みかどうかはこの名前で判断する
+    - 新着は workers 本のスレッドがそれぞれ自分の SFTP チャネルで並列に取得する
+    - 取得は tmp に書いてサイズ（JPEGなら末尾のEOIマーカー）を確かめてから rename する。
+      ai_worker が書きかけのJPEGを拾うことは無く、ロボット側で書き込み中だったファイルは次の周回で取り直す
+    """
+
+    MAX_ATTEMPTS = 5
+    RECENT_NAMES = 5000
+
+    def __init__(
+        self,
+        link: RobotLink,
+        remote_dir: str,
+        local_dir: str,
+        *,
+        suffix: str = ".jpg",
+        workers: int = 4,
+        cursor_path: Optional[str] = None,
+        full_rescan_sec: float = 60.0,
+    ):
+        self.link = link
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        self.suffix = suffix.lower()
+        self.workers = max(1, int(workers))
+        self.cursor_path = cursor_path
+        self.full_rescan_sec = float(full_rescan_sec)
+
+        self._cursor_mtime = 0
+        self._cursor_names: Set[str] = set()  # カーソルと同じ mtime で取得済みのもの
+        self._retry: Dict[str, int] = {}  # 取得に失敗したファイル → 試行回数
+        self._recent: Deque[str] = deque(maxlen=self.RECENT_NAMES)  # 直近に取得したファイル名（古い順）
+        self._recent_set: Set[str] = set()
+        self._dir_mtime: Optional[int] = None
+        self._confirm = False
+        self._last_listing = 0.0
+
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-fetch")
+        self._local = threading.local()
+        self.listings = 0
+        self.fetched = 0
+        self.clock_resets = 0
+
+        os.makedirs(local_dir, exist_ok=True)
+        self._load_cursor()
+
+    def _load_cursor(self) -> None:
+        if not self.cursor_path:
+            return
+        try:
+            with open(self.cursor_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._cursor_mtime = int(data.get("mtime", 0))
+            self._cursor_names = set(data.get("names", []))
+            self._retry = {str(k): int(v) for k, v in (data.get("retry") or {}).items()}
+            for name in data.get("recent", []):
+                self._remember(name)
+        except Exception:
+            pass
+
+    def _save_cursor(self) -> None:
+        if not self.cursor_path:
+            return
+        try:
+            Path(os.path.dirname(self.cursor_path) or ".").mkdir(parents=True, exist_ok=True)
+            _write_json_atomic(self.cursor_path, {
+                "mtime": self._cursor_mtime,
+                "names": sorted(self._cursor_names),
+                "retry": self._retry,
+                "recent": list(self._recent),
+            })
+        except Exception as e:
+            print(f"⚠️ 画像カーソル保存失敗: {e}")
+
+    def _remember(self, name: str) -> None:
+        if name in self._recent_set:
+            return
+        if len(self._recent) == self._recent.maxlen:
+            self._recent_set.discard(self._recent[0])
+        self._recent.append(name)
+        self._recent_set.add(name)
+
+    def _thread_sftp(self):
+        """取得スレッドごとの SFTP チャネル（接続が張り直されたら開き直す）"""
+        cached = getattr(self._local, "sftp", None)
+        if cached is not None and cached[0].is_active():
+            return cached[1]
+        client = self.link.client()
+        if client is None:
+            raise ConnectionError(f"{self.link.name} is not connected")
+        transport = client.get_transport()
+        if cached is None or cached[0] is not transport:
+            if cached is not None:
+                try:
+                    cached[1].close()
+                except Exception:
+                    pass
+            self._local.sftp = (transport, client.open_sftp())
+        return self._local.sftp[1]
+
+    def _fetch_one(self, name: str, size: int) -> bool:
+        local_path = os.path.join(self.local_dir, name)
+        tmp_path = f"{local_path}.tmp"
+        try:
+            sftp = self._thread_sftp()
+            sftp.get(f"{self.remote_dir.rstrip('/')}/{name}", tmp_path)
+            if os.path.getsize(tmp_path) != size:
+                raise ValueError("size changed while fetching")
+            if self.suffix in (".jpg", ".jpeg"):
+                with open(tmp_path, "rb") as f:
+                    f.seek(-2, os.SEEK_END)
+                    if f.read(2) != JPEG_EOI:
+                        raise ValueError("truncated jpeg")
+            os.replace(tmp_path, local_path)
+            return True
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+    def _list_all(self, sftp) -> List[Tuple[int, str, int]]:
+        entries = []
+        for attr in sftp.listdir_attr(self.remote_dir):
+            name = attr.filename
+            if not name.lower().endswith(self.suffix) or not stat.S_ISREG(attr.st_mode or 0):
+                continue
+            entries.append((int(attr.st_mtime or 0), name, int(attr.st_size or 0)))
+        entries.sort()
+        return entries
+
+    def _select_new(self, listing: List[Tuple[int, str, int]], full: bool) -> List[Tuple[int, str, int]]:
+        entries = []
+        for mtime, name, size in listing:
+            attempts = self._retry.get(name)
+            if attempts is not None:
+                # 諦めかけのものは全件確認の時だけ試す
+                if attempts < self.MAX_ATTEMPTS or full:
+                    entries.append((mtime, name, size))
+                continue
+            seen = (
+                mtime < self._cursor_mtime
+                or (mtime == self._cursor_mtime and name in self._cursor_names)
+                or name in self._recent_set
+            )
+            if not seen:
+                entries.append((mtime, name, size))
+        return entries
+
+    def _needs_listing(self, sftp, now: float) -> Tuple[bool, bool]:
+        """(一覧を取るか, 全件確認の周回か)"""
+        full = now - self._last_listing >= self.full_rescan_sec
+        dir_mtime = int(sftp.stat(self.remote_dir).st_mtime or 0)
+        if dir_mtime != self._dir_mtime:
+            self._dir_mtime = dir_mtime
+            self._confirm = True
+            return True, full
+        if self._confirm or any(n < self.MAX_ATTEMPTS for n in self._retry.values()):
+            self._confirm = False
+            return True, full
+        return full, full
+
+    def poll(self) -> List[str]:
+        """新着画像を取得して、取得できたファイル名を返す"""
+        now = time.monotonic()
+        sftp = self.link.sftp()
+        if sftp is None:
+            return []
+        try:
+            needed, full = self._needs_listing(sftp, now)
+            if not needed:
+                return []
+            listing = self._list_all(sftp)
+        except Exception:
+            self.link.check()
+            return []
+        self._last_listing = now
+        self.listings += 1
+
+        changed = False
+        listed = {name for _, name, _ in listing}
+        for name in [n for n in self._retry if n not in listed]:
+            print(f"⚠️ ロボット側から消えたため画像取得を諦めました: {name}")
+            del self._retry[name]
+            changed = True
+        if listing and listing[-1][0] < self._cursor_mtime:
+            # 一覧で一番新しいファイルでもカーソルより古い＝ロボットの時計が戻った。
+            # カーソルを捨てて、取得済みかどうかは直近の取得名で判断する
+            print(f"⚠️ ロボット側の時刻がカーソルより戻っています（{listing[-1][0]} < {self._cursor_mtime}）。カーソルを戻します")
+            self._cursor_mtime, self._cursor_names = 0, set()
+            self.clock_resets += 1
+            changed = True
+
+        entries = self._select_new(listing, full)
+        if not entries:
+            if changed:
+                self._save_cursor()
+            return []
+
+        # ローカルに既にある（前回起動時の取りこぼし等）ものは取らない
+        todo = [(m, n, s) for m, n, s in entries if not os.path.exists(os.path.join(self.local_dir, n))]
+        results = dict(zip(
+            [n for _, n, _ in todo],
+            self._pool.map(lambda e: self._fetch_one(e[1], e[2]), todo),
+        ))
+
+        fetched = []
+        for mtime, name, _ in entries:
+            if results.get(name, True):
+                self._retry.pop(name, None)
+                self._remember(name)
+                if name in results:
+                    fetched.append(name)
+            else:
+                attempts = self._retry.get(name, 0) + 1
+                self._retry[name] = attempts
+                if attempts == self.MAX_ATTEMPTS:
+                    print(f"⚠️ 画像取得に{attempts}回失敗しました: {name}（以降は全件確認の時に再試行）")
+            # 失敗分は _retry（カーソルと一緒に保存）で拾い直すので、カーソルは一覧の最後まで進めてよい
+            if mtime > self._cursor_mtime:
+                self._cursor_mtime = mtime
+                self._cursor_names = set()
+            if mtime == self._cursor_mtime:
+                self._cursor_names.add(name)
+
+        self.fetched += len(fetched)
+        self._save_cursor()
+        if len(fetched) < len(todo):
+            self.link.check()
+        return fetched
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+
+class RemoteTailFetcher:
+    """
+    ロボット側で追記され続けるログ（tracking.csv）を、前回の続きのバイトだけ SFTP で読んでローカルに追記する。
+
+    - 毎回は stat だけ。サイズが増えていたら「前回末尾の MARK_BYTES バイト + 新しい分」を1回の読み出しで取る
+    - 読んだ先頭がローカル末尾と一致しなければ（ログが作り直された）、全体を取り直して置き換える。
+      サイズが縮んだ時も同様（SFTPではinodeが取れないので、中身の一致で連続性を確かめる）
+    - ローカルはリモートと同じバイト列のまま追記だけされるので、TrackingIndex/TrackingDeltaSender も追記分だけ読めばよい
+    """
+
+    MARK_BYTES = 64
+
+    def __init__(self, link: RobotLink, remote_path: str, local_path: str, *, max_chunk_bytes: int = 4 * 1024 * 1024):
+        self.link = link
+        self.remote_path = remote_path
+        self.local_path = local_path
+        self.max_chunk_bytes = int(max_chunk_bytes)
+
+        self._offset: Optional[int] = None  # ローカルに持っているリモートのバイト数
+        self._mark = b""
+        self.bytes_fetched = 0
+        self.refetches = 0
+
+    def _load_local(self) -> None:
+        try:
+            with open(self.local_path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                self._offset = f.tell()
+                f.seek(max(0, self._offset - self.MARK_BYTES))
+                self._mark = f.read()
+        except OSError:
+            self._offset, self._mark = 0, b""
+
+    def _refetch(self, sftp) -> int:
+        tmp_path = f"{self.local_path}.tmp"
+        sftp.get(self.remote_path, tmp_path)
+        os.replace(tmp_path, self.local_path)
+        self.refetches += 1
+        self._load_local()
+        self.bytes_fetched += self._offset or 0
+        return self._offset or 0
+
+    def poll(self) -> int:
+        """リモートの追記分を取り込み、ローカルに書いたバイト数を返す"""
+        sftp = self.link.sftp()
+        if sftp is None:
+            return 0
+        try:
+            if self._offset is None:
+                Path(os.path.dirname(self.local_path) or ".").mkdir(parents=True, exist_ok=True)
+                self._load_local()
+            size = int(sftp.stat(self.remote_path).st_size or 0)
+            if size == self._offset:
+                return 0
+            if size < self._offset:
+                return self._refetch(sftp)
+
+            start = self._offset - len(self._mark)
+            end = min(size, self._offset + self.max_chunk_bytes)
+            with sftp.open(self.remote_path, "rb") as f:
+                f.seek(start)
+                data = f.read(end - start)
+            if data[: len(self._mark)] != self._mark:
+                return self._refetch(sftp)
+
+            new_bytes = data[len(self._mark):]
+            if not new_bytes:
+                return 0
+            with open(self.local_path, "ab") as out:
+                out.write(new_bytes)
+            self._offset += len(new_bytes)
+            self._mark = (self._mark + new_bytes)[-self.MARK_BYTES:]
+            self.bytes_fetched += len(new_bytes)
+            return len(new_bytes)
+        except FileNotFoundError:
+            return 0  # ロボット側でまだログが作られていない
+        except Exception:
+            self._offset = None  # ローカルの状態から読み直す
+            self.link.check()
+            return 0
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Dict, Optional
+
+import paramiko
+
+
+class RobotLink:
+    """
+    1台のロボットへの SSH 接続を張りっぱなしにして使い回す。
+
+    - 接続（鍵交換+パスワード認証）は初回と切断後だけ。以降は同じ Transport 上にチャネルを開く
+    - SFTP セッションも1本持っておき、listdir/読み出しで使い回す
+    - 接続に失敗したら backoff_min_sec から倍々（最大 backoff_max_sec）で再接続を待つ
+      （Wi-Fi 圏外のロボットに毎秒タイムアウトを待たされない）
+    - keepalive で無通信時も死活を見て、切れていたら次の client() で張り直す
+    """
+
+    def __init__(
+        self,
+        name: str,
+        host: str,
+        user: str,
+        password: str,
+        *,
+        port: int = 22,
+        connect_timeout: float = 3.0,
+        keepalive_sec: int = 15,
+        backoff_min_sec: float = 1.0,
+        backoff_max_sec: float = 30.0,
+    ):
+        self.name = name
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = int(port)
+        self.connect_timeout = float(connect_timeout)
+        self.keepalive_sec = int(keepalive_sec)
+        self.backoff_min_sec = float(backoff_min_sec)
+        self.backoff_max_sec = float(backoff_max_sec)
+
+        self._client: Optional[paramiko.SSHClient] = None
+        self._sftp: Optional[paramiko.SFTPClient] = None
+        self._lock = threading.RLock()
+        self._backoff = 0.0
+        self._next_attempt = 0.0
+
+        # 計測値（report() で表示）
+        self.connects = 0
+        self.failures = 0
+        self.reuses = 0
+        self.last_connect_ms = 0.0
+        self.total_connect_ms = 0.0
+
+    @property
+    def connected(self) -> bool:
+        client = self._client
+        transport = client.get_transport() if client is not None else None
+        return bool(transport is not None and transport.is_active())
+
+    def _connect(self) -> Optional[paramiko.SSHClient]:
+        now = time.monotonic()
+        if now < self._next_attempt:
+            return None  # バックオフ中
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        started = time.perf_counter()
+        try:
+            client.connect(
+                self.host,
+                port=self.port,
+                username=self.user,
+                password=self.password,
+                timeout=self.connect_timeout,
+                banner_timeout=self.connect_timeout,
+                auth_timeout=self.connect_timeout,
+            )
+        except Exception as e:
+            client.close()
+            self.failures += 1
+            self._backoff = min(self.backoff_max_sec, max(self.backoff_min_sec, self._backoff * 2))
+            self._next_attempt = time.monotonic() + self._backoff
+            print(f"⚠️ 接続エラー [{self.name} {self.host}]: {e}（{self._backoff:g}秒後に再接続）")
+            return None
+
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        transport = client.get_transport()
+        if transport is not None and self.keepalive_sec > 0:
+            transport.set_keepalive(self.keepalive_sec)
+        self.connects += 1
+        self.last_connect_ms = elapsed_ms
+        self.total_connect_ms += elapsed_ms
+        self._backoff = 0.0
+        self._next_attempt = 0.0
+        self._client = client
+        return client
+
+    def client(self) -> Optional[paramiko.SSHClient]:
+        """接続済みの SSHClient を返す（必要なら接続する）。繋がらない/バックオフ中は None"""
+        with self._lock:
+            if self.connected:
+                self.reuses += 1
+                return self._client
+            self._drop()
+            return self._connect()
+
+    def sftp(self) -> Optional[paramiko.SFTPClient]:
+        """使い回しの SFTP セッション。繋がらない時は None"""
+        with self._lock:
+            client = self.client()
+            if client is None:
+                return None
+            if self._sftp is None:
+                try:
+                    self._sftp = client.open_sftp()
+                except Exception as e:
+                    print(f"⚠️ SFTP開始エラー [{self.name}]: {e}")
+                    self.check()
+                    return None
+            return self._sftp
+
+    def check(self) -> bool:
+        """操作が失敗した時に呼ぶ。接続自体が死んでいたら捨てて、次回張り直させる"""
+        with self._lock:
+            if self.connected:
+                return True
+            self._drop()
+            return False
+
+    def _drop(self) -> None:
+        sftp, client = self._sftp, self._client
+        self._sftp = None
+        self._client = None
+        for obj in (sftp, client):
+            if obj is None:
+                continue
+            try:
+                obj.close()
+            except Exception:
+                pass
+
+    def abort(self) -> None:
+        """
+        処理中の操作がブロックしている時に外から呼ぶ。ロックを取らずに接続を切るので、
+        読み書き中のチャネルは例外で抜け、次の client() で張り直される。
+        """
+        client = self._client
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        with self._lock:
+            self._drop()
+
+    def stats(self) -> dict:
+        avg_ms = self.total_connect_ms / self.connects if self.connects else 0.0
+        return {
+            "connected": self.connected,
+            "connects": self.connects,
+            "failures": self.failures,
+            "reuses": self.reuses,
+            "last_connect_ms": round(self.last_connect_ms, 1),
+            "avg_connect_ms": round(avg_ms, 1),
+            # 使い回さずに毎回接続していたら掛かっていたはずのハンドシェイク時間
+            "saved_sec": round(self.reuses * avg_ms / 1000.0, 1),
+        }
+
+
+class RobotLinkPool:
+    """ROBOT_CONFIG の各ロボットに RobotLink を1本ずつ持つ"""
+
+    def __init__(self, config: Dict[str, dict], **link_kwargs):
+        self.links: Dict[str, RobotLink] = {
+            name: RobotLink(
+                name,
+                conf["host"],
+                conf["user"],
+                conf["pass"],
+                port=int(conf.get("port", 22)),
+                **link_kwargs,
+            )
+            for name, conf in config.items()
+        }
+
+    def get(self, name: str) -> RobotLink:
+        return self.links[name]
+
+    def report(self) -> None:
+        for name, link in self.links.items():
+            s = link.stats()
+            state = "接続中" if s["connected"] else "切断"
+            print(
+                f"🔗 [{name}] {state} 接続 {s['connects']}回 (直近 {s['last_connect_ms']:.0f}ms / "
+                f"平均 {s['avg_connect_ms']:.0f}ms) 失敗 {s['failures']}回 再利用 {s['reuses']}回 "
+                f"(ハンドシェイク節約 約{s['saved_sec']:.1f}秒)"
+            )
+
+    def close(self) -> None:
+        for link in self.links.values():
+            link.close()
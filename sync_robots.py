@@ -1,11 +1,9 @@
-import paramiko
-from scp import SCPClient
+import hashlib
 import os
 import time
 import datetime
 import sys
-from typing import Optional, Set
-from urllib.parse import urljoin
+from typing import Dict, List, Optional, Tuple
 
 # クラウド送信用のライブラリ
 try:
@@ -13,6 +11,11 @@ try:
 except Exception:
     requests = None  # type: ignore
 
+from ingest_client import IngestClient, TrackingDeltaSender
+from relay_scheduler import PeriodicTask, TaskScheduler
+from remote_fetch import RemoteImageFetcher, RemoteTailFetcher
+from robot_link import RobotLinkPool
+
 # Pillow はPGM→PNG変換で使用
 try:
     from PIL import Image  # type: ignore
@@ -48,9 +51,18 @@ STATIC_DIR = "./static"
 LOCAL_MAP_YAML = os.path.join(LOCAL_DIR, "map.yaml")
 LOCAL_MAP_IMAGE = os.path.join(LOCAL_DIR, "map_image")
 STATIC_MAP_PNG = os.path.join(STATIC_DIR, "map.png")
+IMAGE_CURSOR_FILE = os.path.join(LOCAL_DIR, "remote_images.cursor.json")  # 取得済み画像の位置（再起動しても取り直さない）
 
-# 更新間隔
+# 更新間隔（各タスクは別スレッドで独立に回るので、1台が遅くても他は止まらない）
+CSV_SYNC_INTERVAL_SEC = 1
+IMAGE_SYNC_INTERVAL_SEC = 1
 MAP_SYNC_INTERVAL_SEC = 15
+MAP_FORCE_CHECK_SEC = 300  # 地図のサイズ/更新時刻が同じでも、この間隔で中身を取り直して比べる
+UPLOAD_INTERVAL_SEC = 1
+# これを超えて終わらない取得は、その接続を切って張り直させる
+PULL_TIMEOUT_SEC = int(os.environ.get("PULL_TIMEOUT_SEC", "30"))
+IMAGE_FETCH_WORKERS = int(os.environ.get("IMAGE_FETCH_WORKERS", "4"))  # 新着画像を並列に取るSFTPチャネル数
+LINK_REPORT_INTERVAL_SEC = int(os.environ.get("LINK_REPORT_INTERVAL_SEC", "300"))  # SSH接続状況/タスク遅れの表示間隔（0で無効）
 
 # クラウド設定（環境変数から読み込み）
 REMOTE_APP_URL = os.environ.get("REMOTE_APP_URL")  # 例: https://xxxx.onrender.com
@@ -61,16 +73,10 @@ os.makedirs(LOCAL_RAW_IMG_DIR, exist_ok=True)
 os.makedirs(STATIC_DIR, exist_ok=True)
 # ============================================
 
-def create_client(host, user, password):
-    """SSH接続クライアントを作成"""
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    try:
-        client.connect(host, username=user, password=password, timeout=3.0)
-        return client
-    except Exception as e:
-        print(f"⚠️ 接続エラー [{host}]: {e}")
-        return None
+# ロボットごとのSSH接続（張りっぱなしで使い回し、切れたらバックオフ付きで張り直す）
+robot_links = RobotLinkPool(ROBOT_CONFIG)
+_image_fetcher: Optional[RemoteImageFetcher] = None
+_csv_fetcher: Optional[RemoteTailFetcher] = None
 
 def sync_time():
     """PCの時刻をロボットに強制同期させる"""
@@ -78,7 +84,8 @@ def sync_time():
     print(f"🕒 時刻合わせを開始します... ({now_str})")
     
     for name, conf in ROBOT_CONFIG.items():
-        client = create_client(conf["host"], conf["user"], conf["pass"])
+        link = robot_links.get(name)
+        client = link.client()
         if client:
             try:
                 cmd = f'sudo -S date -s "{now_str}"'
@@ -92,59 +99,76 @@ def sync_time():
                     print(f"  ✅ [{name}] 同期完了")
             except Exception as e:
                 print(f"  ❌ [{name}] エラー: {e}")
-            finally:
-                client.close()
+                link.check()
 
 def download_csv():
-    """XavierからCSVをダウンロード"""
-    conf = ROBOT_CONFIG["xavier"]
-    client = create_client(conf["host"], conf["user"], conf["pass"])
-    if client:
-        try:
-            with SCPClient(client.get_transport()) as scp:
-                scp.get(conf["remote_csv"], LOCAL_CSV)
-        except Exception as e:
-            pass 
-        finally:
-            client.close()
-
-def download_images(downloaded_images: Set[str]):
-    """TX2から全jpgをraw_imagesへダウンロード"""
-    conf = ROBOT_CONFIG["tx2"]
-    client = create_client(conf["host"], conf["user"], conf["pass"])
-    if client:
-        try:
-            stdin, stdout, stderr = client.exec_command(f"ls {conf['remote_img_dir']}")
-            files = stdout.read().decode().splitlines()
-            
-            with SCPClient(client.get_transport()) as scp:
-                for file in files:
-                    if not file.endswith(".jpg"): continue
-                    if file in downloaded_images: continue
-
-                    local_path = os.path.join(LOCAL_RAW_IMG_DIR, file)
-                    if os.path.exists(local_path):
-                        downloaded_images.add(file)
-                        continue
-
-                    remote_path = os.path.join(conf["remote_img_dir"], file)
-                    scp.get(remote_path, local_path)
-                    downloaded_images.add(file)
-                    print(f"📸 新着画像GET(raw): {file}")
-        except Exception:
-            pass
-        finally:
-            client.close()
+    """XavierのCSVの追記分だけをダウンロードしてローカルに追記"""
+    global _csv_fetcher
+    if _csv_fetcher is None:
+        _csv_fetcher = RemoteTailFetcher(robot_links.get("xavier"), ROBOT_CONFIG["xavier"]["remote_csv"], LOCAL_CSV)
+    _csv_fetcher.poll()
+
+def download_images():
+    """TX2の新着jpgだけをraw_imagesへダウンロード（一覧はディレクトリ更新時のみ、取得は並列）"""
+    global _image_fetcher
+    if _image_fetcher is None:
+        _image_fetcher = RemoteImageFetcher(
+            robot_links.get("tx2"),
+            ROBOT_CONFIG["tx2"]["remote_img_dir"],
+            LOCAL_RAW_IMG_DIR,
+            workers=IMAGE_FETCH_WORKERS,
+            cursor_path=IMAGE_CURSOR_FILE,
+        )
+    for file in _image_fetcher.poll():
+        print(f"📸 新着画像GET(raw): {file}")
 
 def _atomic_replace(tmp_path: str, final_path: str) -> None:
     os.replace(tmp_path, final_path)
 
-def _scp_get_atomic(scp: SCPClient, remote_path: str, local_path: str) -> None:
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+_sha256_cache: Dict[str, Tuple[int, int, str]] = {}
+
+def _cached_sha256(path: str) -> str:
+    """(mtime, size) が変わった時だけ計算し直す内容ハッシュ"""
+    st = os.stat(path)
+    cached = _sha256_cache.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    digest = _file_sha256(path)
+    _sha256_cache[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+_remote_map_stats: Dict[str, Tuple[int, int, float]] = {}
+
+def _sftp_get_if_changed(sftp, remote_path: str, local_path: str) -> bool:
+    """
+    リモートの (size, mtime) が前回から変わった時（と MAP_FORCE_CHECK_SEC ごと）だけ tmp に取得し、
+    内容ハッシュがローカルと違う時だけ置き換える。置き換えたら True
+    """
+    attr = sftp.stat(remote_path)
+    stat_key = (int(attr.st_size or 0), int(attr.st_mtime or 0))
+    prev = _remote_map_stats.get(remote_path)
+    now = time.time()
+    # mtime は秒単位なので、同じ秒・同じサイズの上書きは定期的な取り直しで拾う
+    if prev is not None and prev[:2] == stat_key and now - prev[2] < MAP_FORCE_CHECK_SEC and os.path.exists(local_path):
+        return False
+
     tmp_path = f"{local_path}.tmp"
-    scp.get(remote_path, tmp_path)
+    sftp.get(remote_path, tmp_path)
     if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) <= 0:
         raise RuntimeError(f"DL failed: {remote_path}")
+    _remote_map_stats[remote_path] = (stat_key[0], stat_key[1], now)
+    if os.path.exists(local_path) and _file_sha256(tmp_path) == _cached_sha256(local_path):
+        os.remove(tmp_path)  # 保存し直しただけで中身は同じ
+        return False
     _atomic_replace(tmp_path, local_path)
+    return True
 
 def _parse_map_yaml_image(local_yaml_path: str) -> Optional[str]:
     try:
@@ -166,20 +190,22 @@ def _convert_to_static_png(local_image_path: str) -> bool:
         with Image.open(local_image_path) as img:
             if img.mode not in ("RGB", "RGBA"):
                 img = img.convert("RGB")
-            img.save(tmp_png)
+            img.save(tmp_png, format="PNG")  # 拡張子 .tmp からは形式を判定できない
         _atomic_replace(tmp_png, STATIC_MAP_PNG)
         return True
     except Exception:
         return False
 
 def download_map():
-    """地図データのダウンロードと変換"""
+    """地図データのダウンロードと変換（中身が変わった時だけ取得/PNG変換する）"""
     conf = ROBOT_CONFIG["xavier"]
-    client = create_client(conf["host"], conf["user"], conf["pass"])
+    link = robot_links.get("xavier")
+    client = link.client()
     if client:
         try:
-            with SCPClient(client.get_transport()) as scp:
-                _scp_get_atomic(scp, conf["remote_map_yaml"], LOCAL_MAP_YAML)
+            # CSV取得スレッドと SFTP セッションを取り合わないよう、地図用に1本開く
+            with client.open_sftp() as sftp:
+                _sftp_get_if_changed(sftp, conf["remote_map_yaml"], LOCAL_MAP_YAML)
                 
                 image_from_yaml = _parse_map_yaml_image(LOCAL_MAP_YAML)
                 if image_from_yaml:
@@ -193,33 +219,96 @@ def download_map():
                 if remote_image:
                     _, ext = os.path.splitext(remote_image)
                     local_image_path = f"{LOCAL_MAP_IMAGE}{ext or '.pgm'}"
-                    _scp_get_atomic(scp, remote_image, local_image_path)
-                    _convert_to_static_png(local_image_path)
+                    changed = _sftp_get_if_changed(sftp, remote_image, local_image_path)
+                    if changed or not os.path.exists(STATIC_MAP_PNG):
+                        _convert_to_static_png(local_image_path)
         except Exception as e:
             print(f"⚠️ 地図同期失敗: {e}")
-        finally:
-            client.close()
+            link.check()
 
 # --- クラウド送信ヘルパー (復活機能) ---
 def _remote_enabled() -> bool:
     return bool(REMOTE_APP_URL and INGEST_TOKEN and requests)
 
+_remote_client = None
+
+def _get_remote_client():
+    """keep-alive で使い回すクラウド送信クライアント（ai_worker と共通の IngestClient）"""
+    global _remote_client
+    if _remote_client is None:
+        # タイムアウト短めで設定（メインループを止めないため）
+        _remote_client = IngestClient(REMOTE_APP_URL, INGEST_TOKEN, timeout=5, retries=1, log_errors=False)
+    return _remote_client
+
 def _remote_post_file(endpoint: str, path: str) -> bool:
     """指定したファイルをクラウドへアップロード"""
     if not _remote_enabled() or not os.path.exists(path):
         return False
-    
-    url = urljoin(REMOTE_APP_URL.rstrip("/") + "/", endpoint.lstrip("/"))
-    headers = {"X-Ingest-Token": INGEST_TOKEN}
-    
+    return _get_remote_client().post_file(endpoint, path)
+
+_tracking_sender = None
+
+def _remote_sync_tracking() -> bool:
+    """tracking.csv の追記分だけをクラウドへ送る（api/ingest/tracking/delta）"""
+    global _tracking_sender
+    if not _remote_enabled():
+        return False
+    if _tracking_sender is None:
+        _tracking_sender = TrackingDeltaSender(_get_remote_client(), LOCAL_CSV)
+    return _tracking_sender.sync()
+
+_uploaded_map_hashes: Dict[str, str] = {}
+
+def _remote_map_status() -> Dict[str, Optional[str]]:
+    """サーバーが取り込み済みの地図の内容ハッシュ（未対応サーバーなら空）"""
+    client = _get_remote_client()
     try:
-        with open(path, "rb") as f:
-            files = {"file": (os.path.basename(path), f)}
-            # タイムアウト短めで設定（メインループを止めないため）
-            r = requests.post(url, headers=headers, files=files, timeout=5)
-        return r.status_code < 300
+        r = client.session.get(client.url("api/ingest/map/status"), timeout=client.timeout)
+        if r.status_code >= 300:
+            return {}
+        return r.json()
     except Exception:
-        return False
+        return {}
+
+def upload_map():
+    """Map YAML & PNG を、中身がサーバーと違う時だけクラウドへ送る"""
+    if not _remote_enabled():
+        return
+    pending = []
+    for kind, path in (("map_yaml", LOCAL_MAP_YAML), ("map_png", STATIC_MAP_PNG)):
+        if not os.path.exists(path):
+            continue
+        digest = _cached_sha256(path)
+        if _uploaded_map_hashes.get(kind) != digest:
+            pending.append((kind, path, digest))
+    if not pending:
+        return
+
+    # 本文を送る前に、サーバーが同じ中身を持っていないか確認する（再起動直後など）
+    server_hashes = _remote_map_status()
+    for kind, path, digest in pending:
+        if server_hashes.get(kind) == digest or _remote_post_file(f"api/ingest/{kind}", path):
+            _uploaded_map_hashes[kind] = digest
+
+def build_tasks() -> List[PeriodicTask]:
+    """ロボットからの取得とクラウドへの送信を、それぞれ独立した周期タスクにする"""
+    xavier = robot_links.get("xavier")
+    tx2 = robot_links.get("tx2")
+    tasks = [
+        # 1. ロボットからダウンロード
+        PeriodicTask("csv", download_csv, CSV_SYNC_INTERVAL_SEC, timeout_sec=PULL_TIMEOUT_SEC, on_timeout=xavier.abort),
+        PeriodicTask("images", download_images, IMAGE_SYNC_INTERVAL_SEC, timeout_sec=PULL_TIMEOUT_SEC, on_timeout=tx2.abort),
+        PeriodicTask("map", download_map, MAP_SYNC_INTERVAL_SEC, timeout_sec=PULL_TIMEOUT_SEC, on_timeout=xavier.abort),
+    ]
+    # 2. クラウドへアップロード (位置情報と地図のみ)
+    # ※ 画像のアップロードは ai_worker.py が担当するためここでは行わない
+    if _remote_enabled():
+        tasks += [
+            # Tracking CSV (位置情報。前回から追記された行だけ送る)
+            PeriodicTask("upload-tracking", _remote_sync_tracking, UPLOAD_INTERVAL_SEC, timeout_sec=60),
+            PeriodicTask("upload-map", upload_map, UPLOAD_INTERVAL_SEC, timeout_sec=120),
+        ]
+    return tasks
 
 def main():
     print("=== 🤖 ロボットデータ完全同期システム (Relay Node) 🤖 ===")
@@ -233,55 +322,25 @@ def main():
     sync_time()
     
     print("\n📡 監視・ダウンロード・クラウド同期を開始します...")
-    
-    last_map_sync = 0.0
-    downloaded_images: Set[str] = set()
-    
-    # クラウド送信の重複防止用タイムスタンプ
-    last_uploaded_csv_mtime: Optional[float] = None
-    last_uploaded_map_yaml_mtime: Optional[float] = None
-    last_uploaded_map_png_mtime: Optional[float] = None
 
+    scheduler = TaskScheduler(build_tasks())
+    scheduler.start()
     try:
         while True:
-            # 1. ロボットからダウンロード
-            download_csv()
-            download_images(downloaded_images)
-            
-            now = time.time()
-            if now - last_map_sync >= MAP_SYNC_INTERVAL_SEC:
-                download_map()
-                last_map_sync = now
-
-            # 2. クラウドへアップロード (位置情報と地図のみ)
-            # ※ 画像のアップロードは ai_worker.py が担当するためここでは行わない
-            if _remote_enabled():
-                # Tracking CSV (位置情報)
-                if os.path.exists(LOCAL_CSV):
-                    mtime = os.path.getmtime(LOCAL_CSV)
-                    if last_uploaded_csv_mtime != mtime:
-                        if _remote_post_file("api/ingest/tracking", LOCAL_CSV):
-                            last_uploaded_csv_mtime = mtime
-                            # print("☁️ 位置情報を送信しました")
-
-                # Map YAML & PNG (地図更新時のみ)
-                if os.path.exists(LOCAL_MAP_YAML):
-                    mtime = os.path.getmtime(LOCAL_MAP_YAML)
-                    if last_uploaded_map_yaml_mtime != mtime:
-                        if _remote_post_file("api/ingest/map_yaml", LOCAL_MAP_YAML):
-                            last_uploaded_map_yaml_mtime = mtime
-
-                if os.path.exists(STATIC_MAP_PNG):
-                    mtime = os.path.getmtime(STATIC_MAP_PNG)
-                    if last_uploaded_map_png_mtime != mtime:
-                        if _remote_post_file("api/ingest/map_png", STATIC_MAP_PNG):
-                            last_uploaded_map_png_mtime = mtime
-            
-            time.sleep(1)
+            if LINK_REPORT_INTERVAL_SEC > 0:
+                time.sleep(LINK_REPORT_INTERVAL_SEC)
+                robot_links.report()
+                scheduler.report()
+            else:
+                time.sleep(60)
             
     except KeyboardInterrupt:
+        scheduler.stop()
+        robot_links.report()
+        scheduler.report()
+        robot_links.close()
         print("\n🛑 停止しました")
         sys.exit(0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import bisect
+import csv
+import os
+import threading
+from array import array
+from typing import List, Optional, Sequence, Tuple
+
+
+_FINGERPRINT_BYTES = 64
+
+
+def _parse_rows(text: str) -> list:
+    rows = []
+    for row in csv.reader(text.splitlines()):
+        if len(row) < 3:
+            continue
+        try:
+            rows.append((float(row[0]), float(row[1]), float(row[2])))
+        except Exception:
+            continue
+    return rows
+
+
+class TrackingIndex:
+    """
+    tracking.csv（時刻,x,y）を時刻順の配列に展開して保持し、
+    撮影時刻に近いロボット座標を二分探索で引くためのインデックス。
+
+    - 前回どこまで読んだか（バイトオフセット/inode）を覚えておき、追記分だけパースする
+    - 全体をアップロードし直す運用（os.replace）でも、先頭と読込位置直前のバイト列が
+      一致すれば「追記された」とみなして続きから読む
+    - 切り詰め/ローテーション（サイズ縮小・内容不一致）の時だけ全体を読み直す
+    - 値は array('d') で持つのでタプルのリストより省メモリ
+    """
+
+    def __init__(self, path: str, *, tolerance_sec: float = 5.0):
+        self.path = path
+        self.tolerance_sec = float(tolerance_sec)
+
+        self._times = array("d")
+        self._xs = array("d")
+        self._ys = array("d")
+
+        self._mtime: Optional[float] = None
+        self._size: Optional[int] = None
+        self._inode: Optional[int] = None
+        self._offset = 0  # 改行まで読み終えたバイト位置
+        self._head = b""  # ファイル先頭のバイト列（差し替え検出用）
+        self._mark = b""  # _offset 直前のバイト列（差し替え検出用）
+        self._provisional = False  # 末尾要素が改行前の暫定行か
+        self._lock = threading.Lock()
+
+        self.full_rebuilds = 0
+        self.bytes_parsed = 0
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    def refresh(self) -> None:
+        """ファイルが更新されていれば追記分を取り込む（変化が無ければstat1回だけ）"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            with self._lock:
+                self._clear_unlocked()
+            return
+
+        with self._lock:
+            if (
+                st.st_mtime == self._mtime
+                and st.st_size == self._size
+                and st.st_ino == self._inode
+            ):
+                return
+            try:
+                with open(self.path, "rb") as f:
+                    if not self._is_continuation_unlocked(f, st.st_size):
+                        self._clear_unlocked()
+                        self.full_rebuilds += 1
+                    self._read_tail_unlocked(f)
+            except OSError:
+                self._clear_unlocked()
+                return
+            self._mtime = st.st_mtime
+            self._size = st.st_size
+            self._inode = st.st_ino
+
+    def _clear_unlocked(self) -> None:
+        self._times = array("d")
+        self._xs = array("d")
+        self._ys = array("d")
+        self._mtime = None
+        self._size = None
+        self._inode = None
+        self._offset = 0
+        self._head = b""
+        self._mark = b""
+        self._provisional = False
+
+    def _is_continuation_unlocked(self, f, size: int) -> bool:
+        """前回読んだ内容がそのまま先頭に残っている（=追記のみ）か"""
+        if self._offset == 0:
+            return True
+        if size < self._offset:
+            return False  # 切り詰め
+        f.seek(0)
+        if f.read(len(self._head)) != self._head:
+            return False
+        f.seek(self._offset - len(self._mark))
+        return f.read(len(self._mark)) == self._mark
+
+    def _read_tail_unlocked(self, f) -> None:
+        if self._provisional:
+            # 前回の改行無し末尾行は書きかけだった可能性があるので捨てて読み直す
+            self._times.pop()
+            self._xs.pop()
+            self._ys.pop()
+            self._provisional = False
+
+        f.seek(self._offset)
+        chunk = f.read()
+        self.bytes_parsed += len(chunk)
+        cut = chunk.rfind(b"\n") + 1
+        complete, partial = chunk[:cut], chunk[cut:]
+
+        if complete:
+            self._append_rows_unlocked(_parse_rows(complete.decode("utf-8", errors="replace")))
+            if self._offset == 0:
+                self._head = complete[:_FINGERPRINT_BYTES]
+            self._offset += len(complete)
+            self._mark = (self._mark + complete)[-_FINGERPRINT_BYTES:]
+
+        if partial:
+            # 最終行に改行が無いログでも引けるよう暫定で入れておく（末尾に足せる場合のみ）
+            rows = _parse_rows(partial.decode("utf-8", errors="replace"))
+            if rows and (not self._times or rows[0][0] >= self._times[-1]):
+                self._append_rows_unlocked(rows[:1])
+                self._provisional = True
+
+    def _append_rows_unlocked(self, rows: list) -> None:
+        if not rows:
+            return
+        in_order = all(rows[i][0] <= rows[i + 1][0] for i in range(len(rows) - 1))
+        if in_order and (not self._times or rows[0][0] >= self._times[-1]):
+            # ロボット側ログは基本的に時刻順なので、通常は末尾に足すだけ
+            self._times.extend(r[0] for r in rows)
+            self._xs.extend(r[1] for r in rows)
+            self._ys.extend(r[2] for r in rows)
+            return
+
+        # 順序が乱れた追記はまとめて安定ソートし直す（まれなケース）
+        merged = list(zip(self._times, self._xs, self._ys)) + rows
+        merged.sort(key=lambda r: r[0])
+        self._times = array("d", (r[0] for r in merged))
+        self._xs = array("d", (r[1] for r in merged))
+        self._ys = array("d", (r[2] for r in merged))
+
+    def nearest(self, target_time: float) -> Tuple[Optional[float], Optional[float]]:
+        """target_time に最も近いサンプルの座標。tolerance_sec を超えてズレたら (None, None)"""
+        self.refresh()
+        with self._lock:
+            times = self._times
+            n = len(times)
+            if n == 0:
+                return None, None
+
+            i = bisect.bisect_left(times, target_time)
+            best = None
+            if i < n:
+                best = i
+            if i > 0 and (best is None or target_time - times[i - 1] <= times[i] - target_time):
+                best = i - 1
+
+            if abs(times[best] - target_time) > self.tolerance_sec:
+                return None, None  # 5秒以上ズレたら無視
+            return self._xs[best], self._ys[best]
+
+    def _interpolate_at_unlocked(self, i: int, t: float) -> Tuple[Optional[float], Optional[float]]:
+        """i は bisect_left(times, t) の結果。前後サンプルの間を線形補間する"""
+        times = self._times
+        n = len(times)
+        tol = self.tolerance_sec
+
+        prev_ok = i > 0 and t - times[i - 1] <= tol
+        next_ok = i < n and times[i] - t <= tol
+
+        if next_ok and times[i] == t:
+            return self._xs[i], self._ys[i]
+        if prev_ok and next_ok:
+            t0, t1 = times[i - 1], times[i]
+            ratio = (t - t0) / (t1 - t0)
+            x = self._xs[i - 1] + (self._xs[i] - self._xs[i - 1]) * ratio
+            y = self._ys[i - 1] + (self._ys[i] - self._ys[i - 1]) * ratio
+            return x, y
+        # 片側しか許容範囲に無い（ログの端/途切れ）場合は近い方をそのまま使う
+        if prev_ok:
+            return self._xs[i - 1], self._ys[i - 1]
+        if next_ok:
+            return self._xs[i], self._ys[i]
+        return None, None
+
+    def interpolate(self, target_time: float) -> Tuple[Optional[float], Optional[float]]:
+        """target_time を挟む2サンプルから座標を線形補間する。前後とも tolerance_sec 外なら (None, None)"""
+        self.refresh()
+        with self._lock:
+            if not self._times:
+                return None, None
+            i = bisect.bisect_left(self._times, target_time)
+            return self._interpolate_at_unlocked(i, target_time)
+
+    def interpolate_many(self, target_times: Sequence[float]) -> List[Tuple[Optional[float], Optional[float]]]:
+        """
+        interpolate の一括版。撮影時刻を並べ替えてサンプル列と1回のマージ走査で突き合わせる。
+        戻り値は target_times と同じ順序。
+        """
+        self.refresh()
+        results: List[Tuple[Optional[float], Optional[float]]] = [(None, None)] * len(target_times)
+        with self._lock:
+            times = self._times
+            n = len(times)
+            if n == 0:
+                return results
+
+            order = sorted(range(len(target_times)), key=lambda k: target_times[k])
+            i = 0
+            for k in order:
+                t = target_times[k]
+                while i < n and times[i] < t:
+                    i += 1
+                results[k] = self._interpolate_at_unlocked(i, t)
+        return results
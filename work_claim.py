@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import fcntl
+import os
+from typing import List, Optional
+
+LOCK_NAME = ".lock"
+
+
+class WorkClaimer:
+    """
+    raw_images の画像を複数の ai_worker プロセスで取り合わないための「取得(claim)」処理。
+
+    - 各ワーカーは inprogress/<worker_id>/ を持ち、raw_images から rename で移してから処理する
+      （同一FS内の rename はアトミックなので、同じ画像を2プロセスが掴むことは無い）
+    - inprogress/<worker_id>/.lock を flock で握っている間だけそのディレクトリは「生きている」
+    - プロセスが落ちると flock はOSが解放するので、残った画像は recover_orphans() で raw_images に戻す
+    """
+
+    def __init__(self, raw_dir: str, inprogress_root: str, worker_id: str):
+        self.raw_dir = raw_dir
+        self.inprogress_root = inprogress_root
+        self.worker_id = worker_id
+        self.work_dir = os.path.join(inprogress_root, worker_id)
+        self._lock_fd: Optional[int] = None
+
+    def acquire(self) -> int:
+        """自分の作業ディレクトリをロックし、前回の残り（クラッシュ時）を raw_images に戻す"""
+        os.makedirs(self.work_dir, exist_ok=True)
+        fd = os.open(os.path.join(self.work_dir, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            raise RuntimeError(f"worker {self.worker_id} is already running ({self.work_dir})")
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._lock_fd = fd
+        return self._return_files(self.work_dir)
+
+    def release(self) -> None:
+        if self._lock_fd is None:
+            return
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _return_files(self, work_dir: str) -> int:
+        returned = 0
+        try:
+            names = os.listdir(work_dir)
+        except OSError:
+            return 0
+        for name in names:
+            if name == LOCK_NAME or not name.lower().endswith(".jpg"):
+                continue
+            try:
+                # 同名が raw_images にあるのは同じ撮影画像なので上書きでよい
+                os.replace(os.path.join(work_dir, name), os.path.join(self.raw_dir, name))
+                returned += 1
+            except OSError:
+                continue
+        return returned
+
+    def recover_orphans(self) -> int:
+        """ロックが解放されている（=プロセスが死んだ）他ワーカーの作業中画像を raw_images に戻す"""
+        returned = 0
+        try:
+            worker_ids = os.listdir(self.inprogress_root)
+        except OSError:
+            return 0
+        for worker_id in worker_ids:
+            work_dir = os.path.join(self.inprogress_root, worker_id)
+            if worker_id == self.worker_id or not os.path.isdir(work_dir):
+                continue
+            try:
+                fd = os.open(os.path.join(work_dir, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue  # 生きているワーカー
+            try:
+                returned += self._return_files(work_dir)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        return returned
+
+    def claim(self, names: List[str]) -> List[str]:
+        """raw_images から作業ディレクトリへ rename できた（=自分が担当する）ファイル名を返す"""
+        claimed = []
+        for name in names:
+            try:
+                os.rename(os.path.join(self.raw_dir, name), os.path.join(self.work_dir, name))
+            except OSError:
+                continue  # 他ワーカーが先に取った/消えた
+            claimed.append(name)
+        return claimed
+
+    def unclaim(self, names: List[str]) -> int:
+        """claim したが処理しないファイルを raw_images に戻す"""
+        returned = 0
+        for name in names:
+            try:
+                os.replace(os.path.join(self.work_dir, name), os.path.join(self.raw_dir, name))
+            except OSError:
+                continue  # 処理済み/既に戻した
+            returned += 1
+        return returned